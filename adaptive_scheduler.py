@@ -0,0 +1,247 @@
+"""Concurrencia adaptativa (AIMD) y límite de peticiones/s para sincronizar con Moodle.
+
+El servidor de Moodle es compartido: demasiadas sesiones en paralelo lo saturan y una sola
+sesión secuencial desaprovecha capacidad. AdaptiveLimiter mide la latencia de cada petición al
+servidor (cargas de página, clics que navegan o guardan formularios, Intro en la búsqueda) y la
+tasa de errores mientras se trabaja y, cada `window` observaciones:
+
+- si la latencia mediana supera `target_latency` o los errores superan `max_error_rate`,
+  reduce la concurrencia de forma multiplicativa (x `decrease`);
+- si no, la aumenta de forma aditiva (+ `increase`),
+
+siempre entre `min_concurrency` y `max_concurrency`. Además, ninguna petición sale antes de
+1/`max_rps` segundos después de la anterior (en todas las sesiones a la vez).
+
+run_adaptive reparte los elementos entre hasta `max_concurrency` sesiones (hilos), cada una
+abierta solo cuando consigue su primer hueco. Se puede probar sin Moodle con
+`python benchmarks.py aimd` (servidor HTTP local con latencia configurable).
+"""
+
+from __future__ import annotations
+
+import queue
+import statistics
+import threading
+import time
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from typing import TypeVar
+
+# Comandos WebDriver que llegan al servidor de Moodle: cargas de página y clics (crear, editar,
+# guardar y quitar filtros navegan o envían un formulario). Además, sendKeysToElement cuando
+# lleva Intro (envía el filtro de búsqueda); el resto de teclas solo rellenan campos.
+SERVER_COMMANDS = ("get", "clickElement")
+SUBMIT_KEYS = ("\ue006", "\ue007")  # Keys.RETURN, Keys.ENTER
+
+T = TypeVar("T")
+S = TypeVar("S")
+R = TypeVar("R")
+
+
+class AdaptiveLimiter:
+    """Límite de concurrencia AIMD + límite de peticiones por segundo (seguro entre hilos)."""
+
+    def __init__(
+        self,
+        min_concurrency: int = 1,
+        max_concurrency: int = 4,
+        max_rps: float = 2.0,
+        target_latency: float = 4.0,
+        max_error_rate: float = 0.1,
+        window: int = 8,
+        increase: float = 1.0,
+        decrease: float = 0.5,
+        log: Callable[[str], None] = print,
+    ) -> None:
+        if not 1 <= min_concurrency <= max_concurrency:
+            raise ValueError(f"Concurrencia inválida: min={min_concurrency}, max={max_concurrency}")
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.max_rps = max_rps
+        self.target_latency = target_latency
+        self.max_error_rate = max_error_rate
+        self.window = window
+        self.increase = increase
+        self.decrease = decrease
+        self.log = log
+
+        self.limit = float(min_concurrency)
+        self.history: list[tuple[float, int]] = [(time.monotonic(), min_concurrency)]
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._rate_lock = threading.Lock()
+        self._next_request = 0.0
+        self._latencies: list[float] = []
+        self._observed = 0
+        self._errors = 0
+        # Cada ajuste abre una época nueva: las peticiones lanzadas antes del ajuste no
+        # cuentan para el siguiente (reflejan la concurrencia anterior).
+        self.epoch = 0
+
+    @property
+    def concurrency(self) -> int:
+        return max(self.min_concurrency, min(self.max_concurrency, int(self.limit)))
+
+    @contextmanager
+    def slot(self):
+        """Espera a que haya hueco (menos de `concurrency` tareas en curso) y lo ocupa."""
+        with self._cond:
+            while self._in_flight >= self.concurrency:
+                self._cond.wait()
+            self._in_flight += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._in_flight -= 1
+                self._cond.notify_all()
+
+    def throttle(self) -> None:
+        """Espera lo necesario para no superar `max_rps` peticiones/s (0 = sin límite)."""
+        if self.max_rps <= 0:
+            return
+        with self._rate_lock:
+            now = time.monotonic()
+            wait = self._next_request - now
+            self._next_request = max(now, self._next_request) + 1.0 / self.max_rps
+        if wait > 0:
+            time.sleep(wait)
+
+    def observe(self, latency: float | None, ok: bool, epoch: int | None = None) -> None:
+        """Registra una petición (latencia en s) o un resultado sin latencia (None) y, al
+        completar la ventana, ajusta la concurrencia. Si se pasa la época en que empezó la
+        petición y ya hubo un ajuste después, se ignora."""
+        with self._cond:
+            if epoch is not None and epoch != self.epoch:
+                return
+            self._observed += 1
+            if not ok:
+                self._errors += 1
+            if latency is not None:
+                self._latencies.append(latency)
+            if self._observed < self.window:
+                return
+
+            error_rate = self._errors / self._observed
+            median = statistics.median(self._latencies) if self._latencies else 0.0
+            old = self.concurrency
+            if error_rate > self.max_error_rate or median > self.target_latency:
+                self.limit = max(float(self.min_concurrency), self.limit * self.decrease)
+            else:
+                self.limit = min(float(self.max_concurrency), self.limit + self.increase)
+            self._latencies.clear()
+            self._observed = self._errors = 0
+            self.epoch += 1
+            new = self.concurrency
+            if new != old:
+                self.history.append((time.monotonic(), new))
+            self._cond.notify_all()
+
+        if new != old:
+            self.log(f"  ⇅ Concurrencia {old} → {new} (latencia mediana {median:.2f}s, errores {error_rate:.0%})")
+
+    def timed(self, fn: Callable[..., R], *args, **kwargs) -> R:
+        """Ejecuta una petición respetando `max_rps` y registra su latencia (error si lanza)."""
+        self.throttle()
+        epoch = self.epoch
+        t0 = time.perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            self.observe(time.perf_counter() - t0, False, epoch)
+            raise
+        self.observe(time.perf_counter() - t0, True, epoch)
+        return result
+
+    def instrument_driver(self, driver, commands: tuple[str, ...] = SERVER_COMMANDS):
+        """Aplica timed() a las peticiones del driver que llegan al servidor: los comandos
+        WebDriver `commands` y las pulsaciones de Intro (sendKeysToElement con SUBMIT_KEYS)."""
+        execute = driver.execute
+
+        def limited(command, params=None):
+            if not _reaches_server(command, params, commands):
+                return execute(command, params)
+            return self.timed(execute, command, params)
+
+        driver.execute = limited
+        return driver
+
+
+def _reaches_server(command: str, params: dict | None, commands: tuple[str, ...]) -> bool:
+    if command in commands:
+        return True
+    if command == "sendKeysToElement" and params:
+        text = params.get("text") or "".join(params.get("value") or ())
+        return any(k in text for k in SUBMIT_KEYS)
+    return False
+
+
+def run_adaptive(
+    items: list[T],
+    abrir_sesion: Callable[[], S],
+    procesar: Callable[[S, T, bool], R],
+    limiter: AdaptiveLimiter,
+    cerrar_sesion: Callable[[S], None] | None = None,
+) -> Iterator[tuple[int, T, R | None, Exception | None]]:
+    """Procesa `items` con hasta limiter.max_concurrency sesiones en paralelo.
+
+    procesar(sesion, item, es_primero) se llama dentro de un hueco del limitador;
+    es_primero indica el primer item de esa sesión. Produce (índice, item, resultado, error)
+    en el hilo que consume, en orden de finalización. Si una sesión no se puede abrir, su
+    item sale con el error y ese hilo termina; los que nadie llegue a procesar salen con
+    RuntimeError.
+    """
+    pendientes: queue.SimpleQueue = queue.SimpleQueue()
+    for idx, item in enumerate(items):
+        pendientes.put((idx, item))
+    hechos: queue.SimpleQueue = queue.SimpleQueue()
+
+    def trabajador() -> None:
+        sesion = None
+        abierta = False
+        es_primero = True
+        try:
+            while True:
+                with limiter.slot():
+                    try:
+                        idx, item = pendientes.get_nowait()
+                    except queue.Empty:
+                        return
+                    try:
+                        if not abierta:
+                            sesion = abrir_sesion()
+                            abierta = True
+                        result = procesar(sesion, item, es_primero)
+                        es_primero = False
+                        hechos.put((idx, item, result, None))
+                    except Exception as e:
+                        limiter.observe(None, False)
+                        hechos.put((idx, item, None, e))
+                        if not abierta:
+                            return
+        finally:
+            if abierta and cerrar_sesion is not None:
+                try:
+                    cerrar_sesion(sesion)
+                except Exception:
+                    pass
+            hechos.put(None)
+
+    hilos = [threading.Thread(target=trabajador, daemon=True) for _ in range(min(limiter.max_concurrency, len(items)))]
+    for h in hilos:
+        h.start()
+
+    vivos = len(hilos)
+    while vivos:
+        msg = hechos.get()
+        if msg is None:
+            vivos -= 1
+            continue
+        yield msg
+
+    while True:
+        try:
+            idx, item = pendientes.get_nowait()
+        except queue.Empty:
+            break
+        yield idx, item, None, RuntimeError("No quedan sesiones disponibles")
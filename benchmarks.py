@@ -0,0 +1,337 @@
+from __future__ import annotations
+
+import argparse
+import csv
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pandas as pd
+
+import openpyxl
+
+import check_emails_in_moodle_export as checker
+import excel_io
+import prepare_faltantes_por_email as prep
+from adaptive_scheduler import AdaptiveLimiter, run_adaptive
+from user_records import email_local_part, first_name, normalize_email
+
+
+def _measure(fn, *args, **kwargs):
+    """Ejecuta fn y devuelve (resultado, segundos, pico de memoria en MB según tracemalloc).
+
+    El tiempo se mide en una ejecución sin tracemalloc (que ralentiza mucho el código Python
+    puro, p.ej. openpyxl) y la memoria en una segunda ejecución con tracemalloc activo.
+    """
+    t0 = time.perf_counter()
+    result = fn(*args, **kwargs)
+    elapsed = time.perf_counter() - t0
+
+    tracemalloc.start()
+    try:
+        fn(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, elapsed, peak / (1024 * 1024)
+
+
+def _report(label: str, elapsed: float, peak_mb: float, baseline: float | None = None) -> None:
+    speedup = f"  x{baseline / elapsed:.1f}" if baseline else ""
+    print(f"  {label:<28} {elapsed:8.3f} s  {peak_mb:9.1f} MB pico{speedup}")
+
+
+# ---------------------------------------------------------------------------
+# moodle-csv: lector del export de Moodle en check_emails_in_moodle_export.py
+# ---------------------------------------------------------------------------
+
+def _write_moodle_export(path: Path, rows: int, extra_cols: int) -> None:
+    header = ["username", "email", "firstname", "lastname"] + [f"profile_field_{i}" for i in range(extra_cols)]
+    with path.open("w", encoding="utf-8", newline="") as f:
+        w = csv.writer(f)
+        w.writerow(header)
+        for i in range(rows):
+            w.writerow(
+                [f"user{i}", f"  User{i}@Example.com ", f"Nombre{i}", f"Apellido{i}"]
+                + [f"valor de perfil {i} {j}" for j in range(extra_cols)]
+            )
+
+
+def _legacy_emails_from_csv(csv_path: Path) -> set[str]:
+    df_csv = pd.read_csv(csv_path)
+    return set(df_csv["email"].dropna().astype(str).map(lambda x: x.strip().lower()).tolist())
+
+
+def bench_moodle_csv(args: argparse.Namespace) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_path = Path(tmp) / "export.csv"
+        _write_moodle_export(csv_path, args.rows, args.extra_cols)
+        size_mb = csv_path.stat().st_size / (1024 * 1024)
+        print(f"Export sintético: {args.rows} filas, {args.extra_cols + 4} columnas, {size_mb:.1f} MB")
+
+        legacy, t_legacy, m_legacy = _measure(_legacy_emails_from_csv, csv_path)
+        _report("pd.read_csv + map (antes)", t_legacy, m_legacy)
+
+        fast, t_fast, m_fast = _measure(checker._emails_from_csv, csv_path, engine="c")
+        _report("usecols + chunks + .str", t_fast, m_fast, t_legacy)
+        assert fast == legacy - {""}, "Resultados distintos entre lectores"
+
+        try:
+            arrow, t_arrow, m_arrow = _measure(checker._emails_from_csv, csv_path, engine="pyarrow")
+        except ImportError:
+            print("  pyarrow no instalado: se omite")
+        else:
+            _report("usecols + pyarrow + .str", t_arrow, m_arrow, t_legacy)
+            assert arrow == fast, "Resultados distintos entre lectores"
+
+
+# ---------------------------------------------------------------------------
+# prepare: derivación de Usuario/Contraseña en prepare_faltantes_por_email.py
+# ---------------------------------------------------------------------------
+
+def _synthetic_registros(rows: int) -> pd.DataFrame:
+    nombres = ["Ana María", "LUIS", None, "  José  Luis ", "Ñoño"]
+    correos = [" User{i}@Example.com", "sin-arroba-{i}", None, "x{i}@a@b.com"]
+    return pd.DataFrame(
+        {
+            prep.COL_APELLIDOS: [f"Apellido{i}" for i in range(rows)],
+            prep.COL_NOMBRE: [nombres[i % len(nombres)] for i in range(rows)],
+            prep.COL_CORREO: [
+                correos[i % len(correos)].format(i=i) if correos[i % len(correos)] else None for i in range(rows)
+            ],
+        }
+    )
+
+
+def _legacy_usuario_contrasena(df_f: pd.DataFrame) -> tuple[list[str], list[str], int, int]:
+    invalid_email = 0
+    empty_name = 0
+    usuarios = []
+    contras = []
+    for _, row in df_f.iterrows():
+        correo = str(row[prep.COL_CORREO]).strip() if pd.notna(row[prep.COL_CORREO]) else ""
+        nombre = str(row[prep.COL_NOMBRE]).strip() if pd.notna(row[prep.COL_NOMBRE]) else ""
+        try:
+            u = email_local_part(correo)
+        except Exception:
+            u = ""
+            invalid_email += 1
+        try:
+            c = f"{first_name(nombre)}+A1+-" if nombre else ""
+        except Exception:
+            c = ""
+            empty_name += 1
+        usuarios.append(u)
+        contras.append(c)
+    return usuarios, contras, invalid_email, empty_name
+
+
+def _legacy_normalize(df: pd.DataFrame) -> pd.Series:
+    return df[prep.COL_CORREO].apply(normalize_email)
+
+
+def bench_prepare(args: argparse.Namespace) -> None:
+    df = _synthetic_registros(args.rows)
+    print(f"Registros sintéticos: {args.rows} filas")
+
+    legacy_norm, t_ln, m_ln = _measure(_legacy_normalize, df)
+    _report("normalize_email .apply", t_ln, m_ln)
+    norm, t_n, m_n = _measure(prep.normalize_email_series, df[prep.COL_CORREO])
+    _report("normalize_email_series", t_n, m_n, t_ln)
+    assert norm.fillna("").tolist() == legacy_norm.fillna("").tolist(), "Normalización distinta"
+
+    legacy, t_legacy, m_legacy = _measure(_legacy_usuario_contrasena, df)
+    _report("iterrows (antes)", t_legacy, m_legacy)
+    fast, t_fast, m_fast = _measure(prep.build_usuario_contrasena, df)
+    _report("build_usuario_contrasena", t_fast, m_fast, t_legacy)
+
+    assert fast[0].tolist() == legacy[0], "Usuarios distintos"
+    assert fast[1].tolist() == legacy[1], "Contraseñas distintas"
+    assert fast[2:] == legacy[2:], "Contadores distintos"
+
+
+# ---------------------------------------------------------------------------
+# xlsx: motores de lectura/escritura de excel_io con la forma de nuestras hojas
+# ---------------------------------------------------------------------------
+
+def _synthetic_hoja(rows: int) -> pd.DataFrame:
+    """Misma forma que la salida del preparador / entrada de la sincronización (7 columnas)."""
+    df = _synthetic_registros(rows)
+    df[prep.COL_TELEFONO] = [600_000_000 + i for i in range(rows)]
+    df[prep.COL_PAIS] = "España"
+    df[prep.COL_USUARIO] = [f"user{i}" for i in range(rows)]
+    df[prep.COL_CONTRASENA] = "Ana+A1+-"
+    return df[prep.OUTPUT_COLUMNS]
+
+
+def _openpyxl_full_cells(path: Path) -> int:
+    """Lectura anterior de moodle_excel_sync.py / excel_completion.py (libro completo + ws.cell)."""
+    ws = openpyxl.load_workbook(path).active
+    return sum(1 for r in range(1, ws.max_row + 1) if ws.cell(r, 3).value)
+
+
+def bench_xlsx(args: argparse.Namespace) -> None:
+    df = _synthetic_hoja(args.rows)
+    print(f"Hoja sintética: {args.rows} filas x {len(df.columns)} columnas")
+    print(f"Motores de lectura disponibles: {', '.join(excel_io.available_engines())}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        base = Path(tmp) / "hoja"
+        xlsx = base.with_suffix(".xlsx")
+
+        print("Escritura:")
+        _, t_ref, m = _measure(df.to_excel, xlsx, index=False, sheet_name="Usuarios")
+        _report("df.to_excel (antes)", t_ref, m)
+        for suffix in (".xlsx", ".csv", ".parquet"):
+            try:
+                _, t, m = _measure(excel_io.write_table, df, base.with_suffix(suffix), sheet_name="Usuarios")
+            except ImportError:
+                print(f"  write_table {suffix}: falta pyarrow, se omite")
+                continue
+            _report(f"write_table {suffix}", t, m, t_ref)
+
+        print("Lectura:")
+        _, t_ref, m = _measure(_openpyxl_full_cells, xlsx)
+        _report("openpyxl libro completo", t_ref, m)
+        for engine in excel_io.available_engines():
+            _, t, m = _measure(excel_io.read_table, xlsx, engine)
+            _report(f"read_table xlsx/{engine}", t, m, t_ref)
+            _, t, m = _measure(excel_io.read_rows, xlsx, engine)
+            _report(f"read_rows xlsx/{engine}", t, m, t_ref)
+        for suffix in (".csv", ".parquet"):
+            if base.with_suffix(suffix).exists():
+                _, t, m = _measure(excel_io.read_table, base.with_suffix(suffix))
+                _report(f"read_table {suffix}", t, m, t_ref)
+
+
+# ---------------------------------------------------------------------------
+# aimd: concurrencia adaptativa (adaptive_scheduler.py) contra un Moodle simulado
+# ---------------------------------------------------------------------------
+
+class _MockMoodle(ThreadingHTTPServer):
+    """Servidor HTTP local que imita un Moodle compartido: cada petición tarda `latency`
+    segundos, y más cuantas más haya en curso por encima de `capacity`; por encima de
+    2 x capacity responde 503 (como un proxy/WAF protegiendo el servidor)."""
+
+    daemon_threads = True
+
+    def __init__(self, latency: float, capacity: int) -> None:
+        super().__init__(("127.0.0.1", 0), _MockMoodleHandler)
+        self.latency = latency
+        self.capacity = capacity
+        self.active = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/admin/user.php"
+
+
+class _MockMoodleHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        srv: _MockMoodle = self.server  # type: ignore[assignment]
+        with srv.lock:
+            srv.active += 1
+            active = srv.active
+        try:
+            overload = max(0, active - srv.capacity)
+            time.sleep(srv.latency * (1 + overload))
+            status = 503 if active > 2 * srv.capacity else 200
+            body = b"<html><body>ok</body></html>"
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with srv.lock:
+                srv.active -= 1
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+def _run_mock_sync(srv: _MockMoodle, limiter: AdaptiveLimiter, rows: int, requests_per_row: int, spike: float):
+    """Procesa `rows` filas de `requests_per_row` peticiones cada una; a mitad de la
+    ejecución multiplica la latencia del servidor por `spike`. Devuelve (s, errores)."""
+
+    def procesar(_sesion, _item, _es_primero):
+        for _ in range(requests_per_row):
+            limiter.timed(lambda: urllib.request.urlopen(srv.url, timeout=30).read())
+        return "ok"
+
+    base_latency = srv.latency
+    errores = hechas = 0
+    t0 = time.perf_counter()
+    for _, _, _, error in run_adaptive(list(range(rows)), lambda: None, procesar, limiter):
+        hechas += 1
+        errores += error is not None
+        if hechas == rows // 2:
+            srv.latency = base_latency * spike
+    srv.latency = base_latency
+    return time.perf_counter() - t0, errores
+
+
+def bench_aimd(args: argparse.Namespace) -> None:
+    srv = _MockMoodle(args.latency, args.capacity)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    print(
+        f"Moodle simulado: latencia {args.latency}s, capacidad {args.capacity} peticiones simultáneas, "
+        f"{args.rows} filas x {args.requests_per_row} peticiones, latencia x{args.spike:g} desde la mitad"
+    )
+    target = args.target_latency or args.latency * 2
+    try:
+        for fixed in sorted({1, args.capacity, args.max_concurrency}):
+            limiter = AdaptiveLimiter(fixed, fixed, max_rps=args.max_rps, target_latency=target, log=lambda _: None)
+            elapsed, errores = _run_mock_sync(srv, limiter, args.rows, args.requests_per_row, args.spike)
+            print(f"  fija {fixed:<2}                   {(args.rows - errores) / elapsed:8.1f} filas OK/s  {errores:4} errores")
+
+        limiter = AdaptiveLimiter(
+            1, args.max_concurrency, max_rps=args.max_rps, target_latency=target, log=lambda _: None
+        )
+        elapsed, errores = _run_mock_sync(srv, limiter, args.rows, args.requests_per_row, args.spike)
+        t_start = limiter.history[0][0]
+        cambios = " ".join(f"{t - t_start:.1f}s:{c}" for t, c in limiter.history[-20:])
+        print(f"  AIMD 1-{args.max_concurrency:<2}                {(args.rows - errores) / elapsed:8.1f} filas OK/s  {errores:4} errores")
+        print(f"    concurrencia en el tiempo (últimos cambios): {cambios}")
+    finally:
+        srv.shutdown()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmarks locales con datos sintéticos (no acceden a Moodle)")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("moodle-csv", help="Lectura del CSV exportado de Moodle en el checker")
+    p.add_argument("--rows", type=int, default=200_000)
+    p.add_argument("--extra-cols", type=int, default=30, help="Campos de perfil adicionales por fila")
+    p.set_defaults(func=bench_moodle_csv)
+
+    p = sub.add_parser("prepare", help="Usuario/Contraseña en prepare_faltantes_por_email.py")
+    p.add_argument("--rows", type=int, default=50_000)
+    p.set_defaults(func=bench_prepare)
+
+    p = sub.add_parser("xlsx", help="Motores de lectura/escritura de excel_io")
+    p.add_argument("--rows", type=int, default=20_000)
+    p.set_defaults(func=bench_xlsx)
+
+    p = sub.add_parser("aimd", help="Concurrencia adaptativa de adaptive_scheduler contra un Moodle simulado")
+    p.add_argument("--rows", type=int, default=120)
+    p.add_argument("--requests-per-row", type=int, default=3)
+    p.add_argument("--latency", type=float, default=0.05, help="Latencia base del servidor simulado (s)")
+    p.add_argument("--capacity", type=int, default=3, help="Peticiones simultáneas antes de degradarse")
+    p.add_argument("--spike", type=float, default=1.0, help="Multiplica la latencia a mitad de la ejecución")
+    p.add_argument("--max-concurrency", type=int, default=8)
+    p.add_argument("--max-rps", type=float, default=0.0, help="Peticiones/s máximas (0 = sin límite)")
+    p.add_argument("--target-latency", type=float, default=None, help="Por defecto: 2 x --latency")
+    p.set_defaults(func=bench_aimd)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
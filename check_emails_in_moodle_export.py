@@ -1,12 +1,24 @@
 from __future__ import annotations
 
 import argparse
+import hashlib
+import json
+import os
+import sqlite3
 import unicodedata
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from functools import partial
 from pathlib import Path
 
 import pandas as pd
 
+from excel_io import ENGINES, read_table, write_table
+from fetch_moodle_users import export_paths, resolve_export
+from file_watch import snapshot, watch
+from run_metrics import RunMetrics
+
 
 def _norm_key(value: str) -> str:
     s = (value or "").strip().lower()
@@ -31,8 +43,8 @@ def _pick_email_column(columns) -> str | None:
     return None
 
 
-def _emails_from_excel(path: Path) -> tuple[set[str], str | None]:
-    df = pd.read_excel(path)
+def _emails_from_excel(path: Path, engine: str | None = None) -> tuple[set[str], str | None]:
+    df = read_table(path, engine)
     col = _pick_email_column(df.columns)
     if not col:
         return set(), None
@@ -42,6 +54,349 @@ def _emails_from_excel(path: Path) -> tuple[set[str], str | None]:
     return set(s.tolist()), col
 
 
+def _emails_from_csv(csv_path: Path, engine: str = "c", chunksize: int = 200_000) -> set[str]:
+    """Lee solo la columna 'email' del export de Moodle y la normaliza de forma vectorizada.
+
+    Con engine="c" se lee por bloques de `chunksize` filas, así que la memoria pico queda
+    acotada por un bloque de la columna email y no por el export completo (que puede traer
+    decenas de campos de perfil). engine="pyarrow" lee la columna entera de una vez, pero
+    con el lector multihilo de Arrow.
+    """
+    header = pd.read_csv(csv_path, nrows=0).columns
+    if "email" not in header:
+        raise SystemExit(f"No encuentro columna 'email' en {csv_path.name}: {list(header)}")
+
+    if engine == "pyarrow":
+        chunks = [pd.read_csv(csv_path, usecols=["email"], dtype={"email": str}, engine="pyarrow")]
+    else:
+        chunks = pd.read_csv(csv_path, usecols=["email"], dtype={"email": str}, chunksize=chunksize)
+
+    emails: set[str] = set()
+    for chunk in chunks:
+        s = chunk["email"].dropna().str.strip().str.lower()
+        emails.update(s[s != ""].unique().tolist())
+    return emails
+
+
+def _pick_column(columns, targets: tuple[str, ...]) -> str | None:
+    """Como _pick_email_column pero solo con coincidencia exacta (normalizada)."""
+    normalized = {c: _norm_key(str(c)) for c in columns}
+    for target in targets:
+        t = _norm_key(target)
+        for c, n in normalized.items():
+            if n == t:
+                return str(c)
+    return None
+
+
+FIRSTNAME_TARGETS = ("nombre", "firstname", "first name")
+LASTNAME_TARGETS = ("apellidos", "apellido", "lastname", "last name", "surname")
+USERNAME_TARGETS = ("usuario", "username", "nombre de usuario")
+USER_FIELDS = ["firstname", "lastname", "username"]
+
+
+def _normalize_names(s: pd.Series) -> pd.Series:
+    """Versión vectorizada de user_records.normalizar_nombre (MAYÚSCULAS -> Título)."""
+    s = s.fillna("").astype(str).str.strip()
+    return s.where(~s.str.isupper(), s.str.title())
+
+
+def _users_from_excel(path: Path, engine: str | None = None) -> tuple[pd.DataFrame, str | None]:
+    """Lee email/nombre/apellidos/usuario de un Excel, con email normalizado en '__email__'.
+
+    Las columnas ausentes quedan vacías. Devuelve también la columna de email detectada.
+    """
+    df = read_table(path, engine)
+    col = _pick_email_column(df.columns)
+    if not col:
+        return pd.DataFrame(columns=["__email__", "fila", *USER_FIELDS]), None
+
+    out = pd.DataFrame({"__email__": df[col], "fila": df.index + 2})
+    for field, targets in zip(USER_FIELDS, (FIRSTNAME_TARGETS, LASTNAME_TARGETS, USERNAME_TARGETS)):
+        c = _pick_column(df.columns, targets)
+        out[field] = df[c] if c else ""
+
+    out["__email__"] = out["__email__"].astype("string").str.strip().str.lower()
+    out = out[out["__email__"].notna() & (out["__email__"] != "")]
+    return out, col
+
+
+def _users_from_excel_safe(
+    path: Path, engine: str | None = None
+) -> tuple[pd.DataFrame | None, str | None, str | None]:
+    try:
+        df, col = _users_from_excel(path, engine)
+    except Exception as e:
+        return None, None, f"{type(e).__name__}: {e}"
+    return df, col, None
+
+
+def _users_from_csv(csv_path: Path, engine: str = "c") -> pd.DataFrame:
+    """Lee email/firstname/lastname/username del export de Moodle (solo esas columnas)."""
+    header = pd.read_csv(csv_path, nrows=0).columns
+    if "email" not in header:
+        raise SystemExit(f"No encuentro columna 'email' en {csv_path.name}: {list(header)}")
+    usecols = ["email", *(c for c in USER_FIELDS if c in header)]
+
+    kwargs = {"engine": "pyarrow"} if engine == "pyarrow" else {}
+    df = pd.read_csv(csv_path, usecols=usecols, dtype=str, **kwargs)
+    for c in USER_FIELDS:
+        if c not in df.columns:
+            df[c] = ""
+
+    df["__email__"] = df["email"].str.strip().str.lower()
+    df = df[df["__email__"].notna() & (df["__email__"] != "")]
+    return df.drop_duplicates(subset=["__email__"], keep="first")[["__email__", *USER_FIELDS]]
+
+
+def _reconcile(df_xlsx: pd.DataFrame, df_csv: pd.DataFrame) -> pd.DataFrame:
+    """Cruza (merge por email normalizado) los Excel con el export de Moodle.
+
+    `df_xlsx` debe traer una columna 'archivo'. Devuelve una fila por discrepancia con
+    columnas: tipo, email, archivo, fila, excel, moodle. Tipos:
+    falta_en_moodle, nombre_distinto, apellidos_distintos, usuario_distinto, no_esta_en_excel.
+    """
+    cols = ["tipo", "email", "archivo", "fila", "excel", "moodle"]
+    merged = df_xlsx.merge(df_csv, on="__email__", how="left", suffixes=("_xlsx", "_csv"), indicator=True)
+    found = merged["_merge"] == "both"
+
+    parts = []
+    missing = merged[~found]
+    parts.append(
+        pd.DataFrame(
+            {
+                "tipo": "falta_en_moodle",
+                "email": missing["__email__"],
+                "archivo": missing["archivo"],
+                "fila": missing["fila"],
+                "excel": "",
+                "moodle": "",
+            }
+        )
+    )
+
+    m = merged[found]
+    checks = (
+        ("nombre_distinto", "firstname", _normalize_names),
+        ("apellidos_distintos", "lastname", _normalize_names),
+        ("usuario_distinto", "username", lambda x: x.fillna("").astype(str).str.strip().str.lower()),
+    )
+    for tipo, field, norm in checks:
+        # Mismas reglas a los dos lados y sin distinguir mayúsculas (como user_records._nombre_completo)
+        xlsx_vals = norm(m[f"{field}_xlsx"])
+        csv_vals = norm(m[f"{field}_csv"])
+        diff = (xlsx_vals != "") & (xlsx_vals.str.casefold() != csv_vals.str.casefold())
+        parts.append(
+            pd.DataFrame(
+                {
+                    "tipo": tipo,
+                    "email": m.loc[diff, "__email__"],
+                    "archivo": m.loc[diff, "archivo"],
+                    "fila": m.loc[diff, "fila"],
+                    "excel": xlsx_vals[diff],
+                    "moodle": csv_vals[diff],
+                }
+            )
+        )
+
+    orphans = df_csv[~df_csv["__email__"].isin(df_xlsx["__email__"])]
+    parts.append(
+        pd.DataFrame(
+            {
+                "tipo": "no_esta_en_excel",
+                "email": orphans["__email__"],
+                "archivo": "",
+                "fila": pd.NA,
+                "excel": "",
+                "moodle": (orphans["firstname"].fillna("") + " " + orphans["lastname"].fillna("")).str.strip(),
+            }
+        )
+    )
+
+    return pd.concat([p[cols] for p in parts], ignore_index=True)
+
+
+def _run_reconcile(
+    csv_path: Path,
+    excel_files: list[Path],
+    out_path: Path,
+    lines: list[str],
+    csv_engine: str,
+    jobs: int,
+    excel_engine: str | None = None,
+    metrics: RunMetrics | None = None,
+) -> int:
+    df_csv = _users_from_csv(csv_path, engine=csv_engine)
+    print(f"CSV (Moodle export): {len(df_csv)} usuarios")
+    lines.append(f"CSV (Moodle export): {csv_path} -> {len(df_csv)} usuarios")
+
+    if jobs > 1 and len(excel_files) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(partial(_users_from_excel_safe, engine=excel_engine), excel_files))
+    else:
+        results = [_users_from_excel_safe(p, excel_engine) for p in excel_files]
+
+    frames = []
+    for path, (df, col, error) in zip(excel_files, results):
+        if error is not None:
+            msg = f"- {path.name}: ERROR leyendo ({error})"
+        elif col is None:
+            msg = f"- {path.name}: NO pude detectar columna de email"
+        else:
+            frames.append(df.assign(archivo=path.name))
+            msg = f"- {path.name}: {len(df)} filas con email (col='{col}')"
+        print(msg)
+        lines.append(msg)
+
+    empty = pd.DataFrame(columns=["__email__", "fila", *USER_FIELDS, "archivo"])
+    df_xlsx = pd.concat(frames, ignore_index=True) if frames else empty
+    report = _reconcile(df_xlsx, df_csv)
+    if metrics is not None:
+        metrics.inc("rows_read", len(df_xlsx) + len(df_csv))
+
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    write_table(report, out_path, sheet_name="Conciliacion")
+
+    lines.append("")
+    counts = report["tipo"].value_counts()
+    for tipo in ("falta_en_moodle", "nombre_distinto", "apellidos_distintos", "usuario_distinto", "no_esta_en_excel"):
+        msg = f"{tipo}: {int(counts.get(tipo, 0))}"
+        print(msg)
+        lines.append(msg)
+
+    print(f"Conciliación escrita en: {out_path}")
+    lines.append(f"Conciliación escrita en: {out_path}")
+
+    discrepancias = len(report) - int(counts.get("no_esta_en_excel", 0))
+    return 0 if discrepancias == 0 else 2
+
+
+CACHE_VERSION = 1
+
+
+def _file_digest(path: Path) -> str:
+    h = hashlib.sha256()
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _open_cache(db_path: Path) -> sqlite3.Connection:
+    db_path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS excel_emails ("
+        " path TEXT PRIMARY KEY,"
+        " size INTEGER NOT NULL,"
+        " mtime_ns INTEGER NOT NULL,"
+        " sha256 TEXT NOT NULL,"
+        " col TEXT,"
+        " emails TEXT NOT NULL,"
+        " version INTEGER NOT NULL)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_excel_emails_sha256 ON excel_emails (sha256)")
+    return conn
+
+
+def _cache_lookup(conn: sqlite3.Connection, path: Path) -> tuple[set[str] | None, str | None, tuple[int, int, str]]:
+    """Busca `path` en la caché. Devuelve (emails o None si no hay hit, columna, firma).
+
+    Primero compara tamaño+mtime (sin leer el archivo); si no coinciden, calcula el hash
+    del contenido, que sigue siendo mucho más barato que parsear el .xlsx (cubre archivos
+    tocados/copiados sin cambios). La firma se pasa luego a _cache_store.
+    """
+    key = str(path.resolve())
+    st = path.stat()
+
+    row = conn.execute(
+        "SELECT size, mtime_ns, sha256, col, emails FROM excel_emails WHERE path = ? AND version = ?",
+        (key, CACHE_VERSION),
+    ).fetchone()
+    if row and row[0] == st.st_size and row[1] == st.st_mtime_ns:
+        return set(json.loads(row[4])), row[3], (st.st_size, st.st_mtime_ns, row[2])
+
+    sig = (st.st_size, st.st_mtime_ns, _file_digest(path))
+    row = conn.execute(
+        "SELECT col, emails FROM excel_emails WHERE sha256 = ? AND version = ? LIMIT 1",
+        (sig[2], CACHE_VERSION),
+    ).fetchone()
+    if not row:
+        return None, None, sig
+
+    emails, col = set(json.loads(row[1])), row[0]
+    _cache_store(conn, path, sig, emails, col)
+    return emails, col, sig
+
+
+def _cache_store(
+    conn: sqlite3.Connection, path: Path, sig: tuple[int, int, str], emails: set[str], col: str | None
+) -> None:
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO excel_emails (path, size, mtime_ns, sha256, col, emails, version)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (str(path.resolve()), *sig, col, json.dumps(sorted(emails)), CACHE_VERSION),
+        )
+
+
+def _emails_from_excel_safe(path: Path, engine: str | None = None) -> tuple[set[str], str | None, str | None]:
+    """Envoltorio para los workers: nunca lanza, devuelve (emails, columna, error)."""
+    try:
+        emails, col = _emails_from_excel(path, engine)
+    except Exception as e:
+        return set(), None, f"{type(e).__name__}: {e}"
+    return emails, col, None
+
+
+def _iter_excel_emails(
+    paths: list[Path], cache: sqlite3.Connection | None = None, jobs: int = 1, engine: str | None = None
+) -> Iterator[tuple[Path, set[str], str | None, bool, str | None]]:
+    """Genera (path, emails, columna, hit_cache, error) en el mismo orden que `paths`.
+
+    Los hits de caché se resuelven en el proceso principal; el resto se parsea en un pool
+    de `jobs` procesos (el parseo XLSX es CPU). Los resultados se emiten en orden a medida
+    que están listos, y un archivo ilegible solo afecta a su propia entrada.
+    """
+    hits: dict[Path, tuple[set[str], str | None]] = {}
+    sigs: dict[Path, tuple[int, int, str]] = {}
+    if cache is not None:
+        for path in paths:
+            try:
+                emails, col, sig = _cache_lookup(cache, path)
+            except OSError:
+                continue
+            sigs[path] = sig
+            if emails is not None:
+                hits[path] = (emails, col)
+
+    to_parse = [p for p in paths if p not in hits]
+    pool = ProcessPoolExecutor(max_workers=jobs) if jobs > 1 and len(to_parse) > 1 else None
+    try:
+        futures = {p: pool.submit(_emails_from_excel_safe, p, engine) for p in to_parse} if pool else {}
+        for path in paths:
+            if path in hits:
+                emails, col = hits[path]
+                yield path, emails, col, True, None
+                continue
+
+            fut = futures.get(path)
+            if fut is None:
+                emails, col, error = _emails_from_excel_safe(path, engine)
+            else:
+                try:
+                    emails, col, error = fut.result()
+                except Exception as e:  # p.ej. BrokenProcessPool si un worker muere
+                    emails, col, error = set(), None, f"{type(e).__name__}: {e}"
+
+            if error is None and cache is not None and path in sigs:
+                _cache_store(cache, path, sigs[path], emails, col)
+            yield path, emails, col, False, error
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+
 def _build_arg_parser() -> argparse.ArgumentParser:
     base_dir = Path(__file__).resolve().parent
 
@@ -56,7 +411,10 @@ def _build_arg_parser() -> argparse.ArgumentParser:
         "--csv",
         type=Path,
         default=base_dir / "Usuarios_12_enero_2026.csv",
-        help="CSV exportado de Moodle con columna 'email' (por defecto: ./Usuarios_12_enero_2026.csv)",
+        help=(
+            "CSV exportado de Moodle con columna 'email' (por defecto: ./Usuarios_12_enero_2026.csv); "
+            "'latest' = último snapshot de fetch_moodle_users.py"
+        ),
     )
     p.add_argument(
         "--log-dir",
@@ -70,13 +428,69 @@ def _build_arg_parser() -> argparse.ArgumentParser:
         default=20,
         help="Cuántos emails faltantes mostrar por archivo en consola (por defecto: 20)",
     )
+    p.add_argument(
+        "--cache",
+        type=Path,
+        default=base_dir / ".cache" / "excel_emails.sqlite",
+        help="Caché SQLite de emails por .xlsx (por defecto: ./.cache/excel_emails.sqlite)",
+    )
+    p.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Ignora la caché y vuelve a leer todos los .xlsx",
+    )
+    p.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Procesos para leer .xlsx en paralelo (por defecto: 1; 0 = todos los núcleos)",
+    )
+    p.add_argument(
+        "--csv-engine",
+        choices=("c", "pyarrow"),
+        default="c",
+        help="Lector del CSV: 'c' por bloques (memoria acotada) o 'pyarrow' (requiere pyarrow)",
+    )
+    p.add_argument(
+        "--excel-engine",
+        choices=ENGINES,
+        default=None,
+        help="Motor de lectura .xlsx (por defecto: calamine si está instalado, si no openpyxl)",
+    )
+    p.add_argument(
+        "--reconcile",
+        type=Path,
+        default=None,
+        help=(
+            "Modo conciliación: cruza Excel y CSV por email y escribe las discrepancias "
+            "(faltantes, nombre/apellidos/usuario distintos, usuarios de Moodle sin Excel) en este .csv/.xlsx"
+        ),
+    )
+    p.add_argument(
+        "--watch",
+        type=float,
+        nargs="?",
+        const=2.0,
+        default=None,
+        metavar="SEGUNDOS",
+        help="Repite el chequeo cada vez que cambia un .xlsx o el CSV (sondeo cada 2s por defecto)",
+    )
     return p
 
 
-def main() -> int:
-    args = _build_arg_parser().parse_args()
+def _excel_files(excel_dir: Path) -> list[Path]:
+    return sorted(excel_dir.glob("*.xlsx")) if excel_dir.exists() else []
 
-    csv_path: Path = args.csv
+
+def _check_once(
+    args: argparse.Namespace, cache: sqlite3.Connection | None, jobs: int, csv_state: dict
+) -> int:
+    """Una pasada completa del chequeo (o de la conciliación). Devuelve el código de salida.
+
+    `csv_state` guarda entre pasadas los emails del CSV y su firma (ruta, tamaño, mtime) para
+    no releerlo en modo watch si no cambió. 'latest' se resuelve en cada pasada.
+    """
+    csv_path: Path = resolve_export(args.csv)
     excel_dir: Path = args.excel_dir
     log_dir: Path = args.log_dir
     max_sample: int = args.max_sample
@@ -84,12 +498,31 @@ def main() -> int:
     log_dir.mkdir(exist_ok=True)
     log_path = log_dir / f"final_check_excel_vs_csv__{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
 
-    df_csv = pd.read_csv(csv_path)
-    if "email" not in df_csv.columns:
-        raise SystemExit(f"No encuentro columna 'email' en {csv_path.name}: {list(df_csv.columns)}")
-    emails_csv = set(df_csv["email"].dropna().astype(str).map(lambda x: x.strip().lower()).tolist())
-
-    excel_files = sorted(excel_dir.glob("*.xlsx")) if excel_dir.exists() else []
+    excel_files = _excel_files(excel_dir)
+    metrics_dir = log_dir / "metrics"
+
+    if args.reconcile is not None:
+        # Nombre propio: su ritmo (filas de Excel + usuarios del CSV) no es comparable con el chequeo
+        metrics = RunMetrics("check_emails_in_moodle_export.reconcile", csv_path.name, metrics_dir)
+        out_path = args.reconcile.resolve()
+        lines = [f"Excel dir: {excel_dir} -> {len(excel_files)} archivos .xlsx"]
+        print(f"Excel dir: {excel_dir} ({len(excel_files)} .xlsx)")
+        with metrics.phase("conciliar"):
+            rc = _run_reconcile(
+                csv_path, excel_files, out_path, lines, args.csv_engine, jobs, args.excel_engine, metrics
+            )
+        log_path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+        print(f"Log escrito en: {log_path}")
+        print(f"Métricas: {metrics.write().name}")
+        return rc
+
+    metrics = RunMetrics("check_emails_in_moodle_export", csv_path.name, metrics_dir)
+    with metrics.phase("csv"):
+        csv_sig = (csv_path, snapshot([csv_path]).get(csv_path))
+        if csv_state.get("sig") != csv_sig or "emails" not in csv_state:
+            csv_state["emails"] = _emails_from_csv(csv_path, engine=args.csv_engine)
+            csv_state["sig"] = csv_sig
+    emails_csv: set[str] = csv_state["emails"]
 
     lines: list[str] = []
     lines.append(f"CSV (Moodle export): {csv_path} -> {len(emails_csv)} emails")
@@ -100,32 +533,41 @@ def main() -> int:
     print(f"Excel dir: {excel_dir} ({len(excel_files)} .xlsx)")
 
     any_missing = False
-    for path in excel_files:
-        try:
-            emails_xlsx, col = _emails_from_excel(path)
-        except Exception as e:
-            print(f"- {path.name}: ERROR leyendo ({type(e).__name__}: {e})")
-            lines.append(f"- {path.name}: ERROR leyendo ({type(e).__name__}: {e})")
-            continue
-
-        if col is None:
-            print(f"- {path.name}: NO pude detectar columna de email")
-            lines.append(f"- {path.name}: NO pude detectar columna de email")
-            continue
-
-        missing = sorted(e for e in emails_xlsx if e not in emails_csv)
-        print(f"- {path.name}: {len(emails_xlsx)} emails (col='{col}') -> faltan en CSV: {len(missing)}")
-        lines.append(f"- {path.name}: {len(emails_xlsx)} emails (col='{col}') -> faltan en CSV: {len(missing)}")
-
-        if missing:
-            any_missing = True
-            for e in missing[:max_sample]:
-                print(f"  - {e}")
-                lines.append(f"  - {e}")
-
-            if len(missing) > max_sample:
-                print(f"  ... +{len(missing) - max_sample} más")
-                lines.append(f"  ... +{len(missing) - max_sample} más")
+    cache_hits = 0
+    with metrics.phase("excel"):
+        for path, emails_xlsx, col, hit, error in _iter_excel_emails(excel_files, cache, jobs, args.excel_engine):
+            cache_hits += hit
+            if error is not None:
+                metrics.inc("archivos_con_error")
+                print(f"- {path.name}: ERROR leyendo ({error})")
+                lines.append(f"- {path.name}: ERROR leyendo ({error})")
+                continue
+
+            if col is None:
+                print(f"- {path.name}: NO pude detectar columna de email")
+                lines.append(f"- {path.name}: NO pude detectar columna de email")
+                continue
+
+            missing = sorted(e for e in emails_xlsx if e not in emails_csv)
+            metrics.inc("rows_read", len(emails_xlsx))
+            metrics.outcome("email_presente", len(emails_xlsx) - len(missing))
+            metrics.outcome("email_faltante", len(missing))
+            print(f"- {path.name}: {len(emails_xlsx)} emails (col='{col}') -> faltan en CSV: {len(missing)}")
+            lines.append(f"- {path.name}: {len(emails_xlsx)} emails (col='{col}') -> faltan en CSV: {len(missing)}")
+
+            if missing:
+                any_missing = True
+                for e in missing[:max_sample]:
+                    print(f"  - {e}")
+                    lines.append(f"  - {e}")
+
+                if len(missing) > max_sample:
+                    print(f"  ... +{len(missing) - max_sample} más")
+                    lines.append(f"  ... +{len(missing) - max_sample} más")
+
+    if cache is not None:
+        print(f"Caché: {cache_hits} reutilizados, {len(excel_files) - cache_hits} leídos/fallidos")
+        lines.append(f"Caché: {cache_hits} reutilizados, {len(excel_files) - cache_hits} leídos/fallidos")
 
     lines.append("")
     lines.append(
@@ -136,9 +578,36 @@ def main() -> int:
 
     log_path.write_text("\n".join(lines) + "\n", encoding="utf-8")
     print(f"Log escrito en: {log_path}")
+    print(f"Métricas: {metrics.write().name}")
 
     return 0 if not any_missing else 2
 
 
+def main() -> int:
+    args = _build_arg_parser().parse_args()
+    if args.reconcile is not None and args.reconcile.resolve().parent == args.excel_dir.resolve():
+        # El siguiente chequeo lo leería como un Excel de intake (columna 'email')
+        raise SystemExit(f"--reconcile no puede escribir en --excel-dir ({args.excel_dir}): elige otra carpeta")
+    resolve_export(args.csv)  # sin snapshots, falla antes de empezar
+
+    jobs: int = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+    cache = None if args.no_cache else _open_cache(args.cache)
+    csv_state: dict = {}
+
+    try:
+        if args.watch is None:
+            return _check_once(args, cache, jobs, csv_state)
+
+        def run(changed: set[Path]) -> None:
+            print(f"\n=== {datetime.now().strftime('%H:%M:%S')} cambios: {', '.join(sorted(p.name for p in changed))}")
+            _check_once(args, cache, jobs, csv_state)
+
+        watch(lambda: [*_excel_files(args.excel_dir), *export_paths(args.csv)], run, interval=args.watch)
+        return 0
+    finally:
+        if cache is not None:
+            cache.close()
+
+
 if __name__ == "__main__":
     raise SystemExit(main())
@@ -0,0 +1,99 @@
+"""Registro local (SQLite) de emails ya procesados.
+
+Sustituye a releer en cada ejecución todos los Excel de intakes anteriores: hay una fila
+por cada par (email normalizado, archivo de origen), con su estado ('preparado' cuando sale
+de prepare_faltantes_por_email.py o de un compare, 'confirmado' cuando moodle_excel_sync.py
+lo crea/edita en Moodle) y las fechas. Así un email que salió en la preparación y después
+aparece en un compare o se confirma en Moodle queda registrado por esa otra vía.
+"""
+
+from __future__ import annotations
+
+import sqlite3
+from collections.abc import Iterable
+from datetime import datetime
+from pathlib import Path
+
+ESTADO_PREPARADO = "preparado"
+ESTADO_CONFIRMADO = "confirmado"
+
+
+def open_registry(db_path: Path) -> sqlite3.Connection:
+    db_path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS emails ("
+        " email TEXT NOT NULL,"
+        " source TEXT NOT NULL,"
+        " estado TEXT NOT NULL,"
+        " first_seen TEXT NOT NULL,"
+        " last_seen TEXT NOT NULL)"
+    )
+    # Versiones anteriores tenían un único origen por email (índice único sobre email)
+    conn.execute("DROP INDEX IF EXISTS idx_emails_email")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_emails_email_source ON emails (email, source)")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS imported_files ("
+        " path TEXT PRIMARY KEY,"
+        " size INTEGER NOT NULL,"
+        " mtime_ns INTEGER NOT NULL,"
+        " imported_at TEXT NOT NULL)"
+    )
+    return conn
+
+
+def register_emails(
+    conn: sqlite3.Connection, emails: Iterable[str], source: str, estado: str = ESTADO_PREPARADO
+) -> None:
+    """Inserta los emails (ya normalizados) con este origen. Si el par (email, origen) ya
+    existía se actualiza last_seen y el estado solo puede avanzar a 'confirmado'."""
+    now = datetime.now().isoformat(timespec="seconds")
+    with conn:
+        conn.executemany(
+            "INSERT INTO emails (email, source, estado, first_seen, last_seen) VALUES (?, ?, ?, ?, ?)"
+            " ON CONFLICT(email, source) DO UPDATE SET"
+            "  last_seen = excluded.last_seen,"
+            "  estado = CASE WHEN excluded.estado = ? THEN excluded.estado ELSE emails.estado END",
+            ((e, source, estado, now, now, ESTADO_CONFIRMADO) for e in emails),
+        )
+
+
+def known_emails(conn: sqlite3.Connection, emails: Iterable[str], exclude_source: str | None = None) -> set[str]:
+    """Devuelve cuáles de `emails` ya están registrados, con una única consulta por lotes.
+
+    `exclude_source` ignora los que solo están 'preparado' desde ese archivo (la propia
+    salida de una ejecución anterior, para que repetir la preparación dé el mismo resultado);
+    si el email está también en otro origen o ya se confirmó en Moodle, cuenta como conocido.
+    """
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS lookup (email TEXT PRIMARY KEY)")
+    try:
+        conn.executemany("INSERT OR IGNORE INTO temp.lookup (email) VALUES (?)", ((e,) for e in emails))
+        rows = conn.execute(
+            "SELECT DISTINCT l.email FROM temp.lookup l JOIN emails e ON e.email = l.email"
+            " WHERE ? IS NULL OR e.source <> ? OR e.estado <> ?",
+            (exclude_source, exclude_source, ESTADO_PREPARADO),
+        ).fetchall()
+    finally:
+        conn.execute("DELETE FROM temp.lookup")
+    return {r[0] for r in rows}
+
+
+def needs_import(conn: sqlite3.Connection, path: Path) -> bool:
+    """True si `path` no se ha importado todavía o cambió (tamaño/mtime) desde entonces."""
+    st = path.stat()
+    row = conn.execute("SELECT size, mtime_ns FROM imported_files WHERE path = ?", (str(path.resolve()),)).fetchone()
+    return row is None or row != (st.st_size, st.st_mtime_ns)
+
+
+def mark_imported(conn: sqlite3.Connection, path: Path) -> None:
+    st = path.stat()
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO imported_files (path, size, mtime_ns, imported_at) VALUES (?, ?, ?, ?)",
+            (str(path.resolve()), st.st_size, st.st_mtime_ns, datetime.now().isoformat(timespec="seconds")),
+        )
+
+
+def count(conn: sqlite3.Connection) -> int:
+    """Número de emails distintos registrados."""
+    return conn.execute("SELECT COUNT(DISTINCT email) FROM emails").fetchone()[0]
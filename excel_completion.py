@@ -1,6 +1,10 @@
 from pathlib import Path
+
 from openpyxl import load_workbook
 
+from run_metrics import RunMetrics
+from user_records import email_local_part, password_for
+
 BASE_DIR = Path(__file__).resolve().parent
 INPUT_XLSX = BASE_DIR / "excel" / "registro_curso_amor_sexualidad2.xlsx"
 OUTPUT_XLSX = BASE_DIR / "excel" / "registro_curso_amor_sexualidad2_rellenado.xlsx"
@@ -17,27 +21,26 @@ COL_CONTRASENA = "Contraseña"
 def is_blank(value) -> bool:
     return value is None or (isinstance(value, str) and value.strip() == "")
 
-def email_local_part(email: str) -> str:
-    email = (email or "").strip()
-    if "@" not in email:
-        raise ValueError(f"Email inválido (sin @): {email!r}")
-    return email.split("@", 1)[0].strip()
-
-def first_name(nombre: str) -> str:
-    nombre = (nombre or "").strip()
-    if not nombre:
-        raise ValueError("Nombre vacío, no puedo generar contraseña.")
-    return nombre.split()[0]
-
 def main():
-    wb = load_workbook(INPUT_XLSX)
-    ws = wb[SHEET_NAME] if SHEET_NAME else wb.active
+    # El libro se carga completo (openpyxl) para guardar una copia con todas sus hojas,
+    # nombres, anchos y estilos. Los valores de la hoja se leen de una pasada a una rejilla
+    # en memoria; grid[r - 1][c - 1] es la celda (fila r, columna c) de Excel.
+    metrics = RunMetrics("excel_completion", INPUT_XLSX.name)
+    with metrics.phase("leer"):
+        wb = load_workbook(INPUT_XLSX)
+        ws = wb[SHEET_NAME] if SHEET_NAME else wb.active
+        grid = [list(row) for row in ws.iter_rows(values_only=True)]
+    max_row = len(grid)
+    max_column = len(grid[0]) if grid else 0
+
+    def cell(r, c):
+        return grid[r - 1][c - 1]
 
     # Detectar cabeceras (normalizando espacios)
     headers = {}
     header_row = 1
-    for col_idx in range(1, ws.max_column + 1):
-        v = ws.cell(row=header_row, column=col_idx).value
+    for col_idx in range(1, max_column + 1):
+        v = cell(header_row, col_idx)
         if isinstance(v, str) and v.strip():
             headers[v.strip()] = col_idx
 
@@ -54,8 +57,8 @@ def main():
     # 1) Validar unicidad de email (avisar pero no abortar)
     seen = {}
     duplicates = {}
-    for r in range(2, ws.max_row + 1):
-        correo = ws.cell(row=r, column=c_correo).value
+    for r in range(2, max_row + 1):
+        correo = cell(r, c_correo)
         if is_blank(correo):
             continue
         correo_norm = str(correo).strip().lower()
@@ -75,8 +78,8 @@ def main():
         for email, rows in duplicates.items():
             nombres = []
             for r in rows:
-                nombre = ws.cell(row=r, column=c_nombre).value
-                apellidos = ws.cell(row=r, column=c_apellidos).value
+                nombre = cell(r, c_nombre)
+                apellidos = cell(r, c_apellidos)
                 nombres.append({
                     'fila': r,
                     'nombre': (nombre or "").strip(),
@@ -107,13 +110,13 @@ def main():
 
     # 2) Rellenar Usuario y Contraseña cuando falte Usuario
     changed = 0
-    for r in range(2, ws.max_row + 1):
-        usuario_val = ws.cell(row=r, column=c_usuario).value
+    for r in range(2, max_row + 1):
+        usuario_val = cell(r, c_usuario)
         if not is_blank(usuario_val):
             continue
 
-        correo = ws.cell(row=r, column=c_correo).value
-        nombre = ws.cell(row=r, column=c_nombre).value
+        correo = cell(r, c_correo)
+        nombre = cell(r, c_nombre)
 
         if is_blank(correo):
             continue
@@ -122,15 +125,20 @@ def main():
         ws.cell(row=r, column=c_usuario).value = u
 
         if not is_blank(nombre):
-            ws.cell(row=r, column=c_contra).value = f"{first_name(str(nombre))}+A1+-"
+            ws.cell(row=r, column=c_contra).value = password_for(str(nombre))
 
         changed += 1
 
-    wb.save(OUTPUT_XLSX)
+    with metrics.phase("escribir"):
+        wb.save(OUTPUT_XLSX)
+    metrics.inc("rows_read", max(max_row - 1, 0))
+    metrics.outcome("rellenada", changed)
+    metrics.outcome("sin_cambios", max(max_row - 1, 0) - changed)
     msg_final = f"OK. Filas actualizadas: {changed}. Guardado en: {OUTPUT_XLSX}"
     if duplicates:
         msg_final += " [⚠ AVISO: Emails duplicados rellenados en todas sus filas; solo el primero se registrará en Moodle]"
     print(msg_final)
+    print(f"Métricas: {metrics.write().name}")
 
 if __name__ == "__main__":
     main()
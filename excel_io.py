@@ -0,0 +1,90 @@
+"""Lectura/escritura de tablas (.xlsx, .csv, .parquet) compartida por todos los scripts.
+
+- Lectura .xlsx con motor seleccionable: 'calamine' (mucho más rápido, requiere
+  python-calamine) u 'openpyxl'. Por defecto se usa calamine si está instalado; se puede
+  forzar con la variable de entorno EXCEL_READ_ENGINE o el parámetro `engine`.
+  Ojo: calamine devuelve vacías las celdas que solo contienen espacios (openpyxl devuelve
+  el texto); todos los scripts las tratan igual porque hacen strip().
+- Escritura .xlsx con openpyxl en modo write-only (streaming, sin mantener el libro en memoria).
+- .csv y .parquet como intermedios entre etapas: se eligen por la extensión del archivo.
+"""
+
+from __future__ import annotations
+
+import importlib.util
+import os
+from pathlib import Path
+
+import pandas as pd
+from openpyxl import Workbook
+
+ENGINES = ("calamine", "openpyxl")
+EXCEL_SUFFIXES = (".xlsx", ".xlsm")
+
+
+def available_engines() -> list[str]:
+    mods = {"calamine": "python_calamine", "openpyxl": "openpyxl"}
+    return [e for e in ENGINES if importlib.util.find_spec(mods[e]) is not None]
+
+
+def default_engine() -> str:
+    env = os.getenv("EXCEL_READ_ENGINE", "").strip().lower()
+    if env:
+        if env not in ENGINES:
+            raise ValueError(f"EXCEL_READ_ENGINE inválido: {env!r} (opciones: {', '.join(ENGINES)})")
+        return env
+    return available_engines()[0]
+
+
+def read_table(path: Path, engine: str | None = None, **kwargs) -> pd.DataFrame:
+    """Lee un .xlsx/.csv/.parquet como DataFrame. `kwargs` se pasan al lector de pandas."""
+    suffix = Path(path).suffix.lower()
+    if suffix == ".csv":
+        return pd.read_csv(path, **kwargs)
+    if suffix == ".parquet":
+        return pd.read_parquet(path, **kwargs)
+    return pd.read_excel(path, engine=engine or default_engine(), **kwargs)
+
+
+def read_rows(path: Path, engine: str | None = None, sheet_name: str | int = 0) -> list[list]:
+    """Lee una hoja (por defecto la primera) como rejilla de valores Python (None = vacía).
+
+    rows[0] es la fila 1 de la hoja (cabeceras), así que la fila N de Excel es rows[N - 1].
+    """
+    suffix = Path(path).suffix.lower()
+    if suffix == ".parquet":
+        df = pd.read_parquet(path)
+        df = pd.concat([pd.DataFrame([list(df.columns)], columns=df.columns), df], ignore_index=True)
+    elif suffix == ".csv":
+        df = pd.read_csv(path, header=None, dtype=object, skip_blank_lines=False)
+    else:
+        df = pd.read_excel(path, engine=engine or default_engine(), sheet_name=sheet_name, header=None, dtype=object)
+    df = df.astype(object)
+    return df.where(df.notna(), None).values.tolist()
+
+
+def write_table(df: pd.DataFrame, path: Path, sheet_name: str = "Sheet1", header: bool = True) -> None:
+    """Escribe df en .xlsx (streaming, write-only), .csv o .parquet según la extensión."""
+    suffix = Path(path).suffix.lower()
+    if suffix == ".csv":
+        df.to_csv(path, index=False, header=header)
+        return
+    if suffix == ".parquet":
+        if not header:
+            # Parquet siempre lleva nombres de columna: la primera fila hace de cabecera
+            # (simétrico con read_rows, que la vuelve a anteponer al leer).
+            df = pd.DataFrame(df.iloc[1:].values, columns=[f"Unnamed: {i}" if c is None else str(c) for i, c in enumerate(df.iloc[0])])
+        # Parquet exige un tipo por columna: las columnas object (texto o mixtas) van como texto.
+        obj_cols = df.select_dtypes(include="object").columns
+        df = df.astype({c: "string" for c in obj_cols})
+        df.to_parquet(path, index=False)
+        return
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(sheet_name)
+    if header:
+        ws.append([str(c) for c in df.columns])
+    values = df.astype(object)
+    for row in values.where(values.notna(), None).itertuples(index=False, name=None):
+        ws.append(row)
+    wb.save(path)
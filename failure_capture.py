@@ -0,0 +1,87 @@
+"""Captura de fallos para diagnosticar después, sin repetir la ejecución a mano.
+
+Solo cuando un usuario termina en error se toman del navegador la URL actual, el HTML de la
+página y una captura de pantalla (las filas correctas no pagan nada). La escritura a disco
+la hace un hilo en segundo plano, en un directorio circular acotado por tamaño:
+
+    logs/failures/<AAAAMMDD_HHMMSS_ffffff>__fila<N>/{meta.json, page.html, screenshot.png}
+
+Cuando el total supera `max_bytes` se borran las capturas más antiguas.
+"""
+
+from __future__ import annotations
+
+import json
+import queue
+import shutil
+import threading
+from datetime import datetime
+from pathlib import Path
+
+
+class FailureCapture:
+    """Guarda en segundo plano el estado del navegador de las filas fallidas."""
+
+    def __init__(self, directory: Path, max_bytes: int = 100 * 1024 * 1024) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.saved = 0
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._writer, name="failure-capture", daemon=True)
+        self._thread.start()
+
+    def capture(self, driver, fila: int, email: str, motivo: str = "") -> None:
+        """Toma URL, HTML y captura del driver (en el hilo del driver) y encola su escritura."""
+        meta = {"fila": fila, "email": email, "motivo": motivo, "ts": datetime.now().isoformat(timespec="seconds")}
+        try:
+            meta["url"] = driver.current_url
+        except Exception as e:
+            meta["url"] = None
+            meta["url_error"] = f"{type(e).__name__}: {e}"[:200]
+        try:
+            html = driver.page_source
+        except Exception:
+            html = None
+        try:
+            png = driver.get_screenshot_as_png()
+        except Exception:
+            png = None
+        self._queue.put((datetime.now().strftime("%Y%m%d_%H%M%S_%f"), meta, html, png))
+
+    def close(self) -> None:
+        """Espera a que se escriban las capturas pendientes."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _writer(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            stamp, meta, html, png = item
+            try:
+                self._write(stamp, meta, html, png)
+                self._prune()
+                self.saved += 1
+            except Exception:
+                pass  # la captura nunca debe romper la sincronización
+
+    def _write(self, stamp: str, meta: dict, html: str | None, png: bytes | None) -> None:
+        entry = self.directory / f"{stamp}__fila{meta['fila']}"
+        entry.mkdir(parents=True, exist_ok=True)
+        if html is not None:
+            (entry / "page.html").write_text(html, encoding="utf-8")
+        if png is not None:
+            (entry / "screenshot.png").write_bytes(png)
+        (entry / "meta.json").write_text(json.dumps(meta, ensure_ascii=False, indent=2) + "\n", encoding="utf-8")
+
+    def _prune(self) -> None:
+        entries = sorted(p for p in self.directory.iterdir() if p.is_dir())
+        sizes = {p: sum(f.stat().st_size for f in p.iterdir()) for p in entries}
+        total = sum(sizes.values())
+        # Se conserva siempre la más reciente aunque por sí sola supere el límite.
+        for p in entries[:-1]:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(p, ignore_errors=True)
+            total -= sizes[p]
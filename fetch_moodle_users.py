@@ -0,0 +1,219 @@
+"""Descarga el listado completo de usuarios de Moodle como snapshot CSV con fecha.
+
+Sustituye al export manual (Usuarios_<fecha>.csv): una sola transferencia en bloque que
+luego usan el checker (`--csv latest`) y pipeline.py (`--csv latest`).
+
+Dos vías:
+- web (por defecto): inicia sesión como moodle_excel_sync.py, selecciona todos los usuarios en
+  la acción en bloque (admin/user/user_bulk.php) y descarga user_bulk_download.php en CSV
+  reutilizando las cookies de esa sesión.
+- ws: si hay token de servicio web (MOODLE_WS_TOKEN), llama a core_user_get_users (todos los
+  emails) por REST y guarda el resultado como CSV. Esta función no pagina: es una petición.
+
+La respuesta se escribe a disco por bloques en .cache/moodle_users/Usuarios_<AAAAMMDD_HHMMSS>.csv.
+Si el snapshot más reciente tiene menos de --max-age minutos, no se descarga de nuevo.
+pipeline.py llama a fetch_snapshot después de sincronizar para verificar con `--csv latest`.
+"""
+
+from __future__ import annotations
+
+import argparse
+import csv
+import json
+import os
+import time
+import urllib.parse
+import urllib.request
+from datetime import datetime
+from pathlib import Path
+
+from run_metrics import RunMetrics
+
+try:
+    from dotenv import load_dotenv
+except Exception:  # pragma: no cover
+    load_dotenv = None
+
+BASE_DIR = Path(__file__).resolve().parent
+SNAPSHOT_DIR = BASE_DIR / ".cache" / "moodle_users"
+SNAPSHOT_PREFIX = "Usuarios_"
+CHUNK_SIZE = 1024 * 1024
+# Columnas primero en el CSV de la vía ws (mismas que el export de Moodle)
+WS_COLUMNS = ("id", "username", "email", "firstname", "lastname")
+
+
+def snapshots(directory: Path = SNAPSHOT_DIR) -> list[Path]:
+    """Snapshots existentes, del más antiguo al más reciente."""
+    return sorted(directory.glob(f"{SNAPSHOT_PREFIX}*.csv")) if directory.exists() else []
+
+
+def latest_snapshot(directory: Path = SNAPSHOT_DIR) -> Path | None:
+    found = snapshots(directory)
+    return found[-1] if found else None
+
+
+def resolve_export(csv_path: Path) -> Path:
+    """'latest' → el snapshot más reciente descargado con este script; otra ruta, tal cual."""
+    if str(csv_path) != "latest":
+        return csv_path
+    latest = latest_snapshot()
+    if latest is None:
+        raise SystemExit(f"No hay snapshots en {SNAPSHOT_DIR}: ejecuta antes python fetch_moodle_users.py")
+    return latest
+
+
+def export_paths(csv_path: Path) -> list[Path]:
+    """Archivos a vigilar en modo watch para `csv_path`: con 'latest', todos los snapshots
+    (una descarga nueva dispara otra pasada); si no, el propio archivo."""
+    return snapshots() if str(csv_path) == "latest" else [csv_path]
+
+
+def _stream_to_file(response, dest: Path) -> int:
+    """Copia la respuesta HTTP a `dest` por bloques. Devuelve los bytes escritos."""
+    total = 0
+    with dest.open("wb") as f:
+        while True:
+            chunk = response.read(CHUNK_SIZE)
+            if not chunk:
+                return total
+            f.write(chunk)
+            total += len(chunk)
+
+
+def _check_csv(path: Path) -> None:
+    with path.open(encoding="utf-8-sig", newline="") as f:
+        header = next(csv.reader(f), [])
+    if "email" not in [h.strip().lower() for h in header]:
+        raise RuntimeError(
+            f"La descarga no es un CSV de usuarios (cabecera: {header[:5]}); ¿sesión caducada o sin permisos?"
+        )
+
+
+def fetch_web(dest: Path, metrics: RunMetrics) -> None:
+    import moodle_excel_sync as sync
+
+    driver = metrics.instrument_driver(sync.crear_driver())
+    try:
+        with metrics.phase("login"):
+            sync.login_moodle(driver)
+        with metrics.phase("seleccionar"):
+            driver.get(f"{sync.MOODLE_BASE_URL}/admin/user/user_bulk.php")
+            time.sleep(2)
+            driver.find_element(sync.By.ID, "id_addall").click()
+            time.sleep(3)
+        cookies = "; ".join(f"{c['name']}={c['value']}" for c in driver.get_cookies())
+        user_agent = driver.execute_script("return navigator.userAgent")
+        url = f"{sync.MOODLE_BASE_URL}/admin/user/user_bulk_download.php?dataformat=csv"
+    finally:
+        driver.quit()
+
+    req = urllib.request.Request(url, headers={"Cookie": cookies, "User-Agent": user_agent})
+    with metrics.phase("descargar"):
+        metrics.inc("http_requests")
+        with urllib.request.urlopen(req, timeout=300) as resp:
+            _stream_to_file(resp, dest)
+    _check_csv(dest)
+
+
+def fetch_ws(dest: Path, token: str, base_url: str, metrics: RunMetrics) -> None:
+    data = urllib.parse.urlencode(
+        {
+            "wstoken": token,
+            "wsfunction": "core_user_get_users",
+            "moodlewsrestformat": "json",
+            "criteria[0][key]": "email",
+            "criteria[0][value]": "%",
+        }
+    ).encode()
+    raw = dest.with_suffix(".json.part")
+    try:
+        with metrics.phase("descargar"):
+            metrics.inc("http_requests")
+            with urllib.request.urlopen(f"{base_url}/webservice/rest/server.php", data=data, timeout=300) as resp:
+                _stream_to_file(resp, raw)
+
+        with metrics.phase("convertir"):
+            payload = json.loads(raw.read_text(encoding="utf-8"))
+            if "exception" in payload:
+                raise RuntimeError(f"Moodle WS: {payload.get('errorcode')}: {payload.get('message')}")
+            users = payload.get("users", [])
+            extra = sorted({k for u in users for k, v in u.items() if k not in WS_COLUMNS and not isinstance(v, (list, dict))})
+            with dest.open("w", encoding="utf-8", newline="") as f:
+                w = csv.DictWriter(f, fieldnames=[*WS_COLUMNS, *extra], extrasaction="ignore")
+                w.writeheader()
+                w.writerows(users)
+    finally:
+        raw.unlink(missing_ok=True)
+
+
+def fetch_snapshot(via: str | None = None, keep: int = 10, log=print) -> Path:
+    """Descarga un snapshot nuevo (vía ws si hay MOODLE_WS_TOKEN, si no web) y devuelve su ruta.
+    Conserva solo los `keep` más recientes (0 = todos)."""
+    if load_dotenv is not None:
+        load_dotenv(BASE_DIR / ".env")
+
+    token = os.getenv("MOODLE_WS_TOKEN", "")
+    via = via or ("ws" if token else "web")
+    SNAPSHOT_DIR.mkdir(parents=True, exist_ok=True)
+    dest = SNAPSHOT_DIR / f"{SNAPSHOT_PREFIX}{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+    part = dest.with_suffix(".csv.part")
+    metrics = RunMetrics("fetch_moodle_users", via)
+
+    log(f"Descargando usuarios de Moodle (vía {via})...")
+    try:
+        if via == "ws":
+            if not token:
+                raise SystemExit("Falta MOODLE_WS_TOKEN en el entorno o en .env para --via ws")
+            base_url = os.getenv("MOODLE_BASE_URL", "https://campus.edufamilia.com").rstrip("/")
+            fetch_ws(part, token, base_url, metrics)
+        else:
+            fetch_web(part, metrics)
+        os.replace(part, dest)
+    finally:
+        part.unlink(missing_ok=True)
+
+    with dest.open(encoding="utf-8-sig", newline="") as f:
+        filas = max(sum(1 for _ in csv.reader(f)) - 1, 0)
+    metrics.inc("rows_read", filas)
+    log(f"OK: {filas} usuarios ({dest.stat().st_size / 1024 / 1024:.1f} MB) -> {dest}")
+
+    for old in snapshots()[:-keep] if keep > 0 else []:
+        old.unlink(missing_ok=True)
+    log(f"Métricas: {metrics.write().name}")
+    return dest
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Descarga todos los usuarios de Moodle a un snapshot CSV (.cache/moodle_users/)."
+    )
+    parser.add_argument(
+        "--via",
+        choices=("web", "ws"),
+        default=None,
+        help="web = sesión de administrador (Selenium); ws = token MOODLE_WS_TOKEN (por defecto: ws si hay token)",
+    )
+    parser.add_argument(
+        "--max-age",
+        type=float,
+        default=60.0,
+        metavar="MINUTOS",
+        help="Reutiliza el último snapshot si tiene menos de estos minutos (por defecto: 60)",
+    )
+    parser.add_argument("--force", action="store_true", help="Descarga aunque haya un snapshot reciente")
+    parser.add_argument("--keep", type=int, default=10, help="Snapshots a conservar (por defecto: 10)")
+    args = parser.parse_args()
+
+    latest = latest_snapshot()
+    if latest is not None and not args.force:
+        age_min = (time.time() - latest.stat().st_mtime) / 60
+        if age_min < args.max_age:
+            print(f"Snapshot reciente ({age_min:.0f} min): {latest}")
+            return 0
+
+    fetch_snapshot(args.via, args.keep)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,63 @@
+"""Modo watch por sondeo (mtime + tamaño) compartido por los scripts de Excel.
+
+Solo usa la librería estándar: funciona en cualquier Linux/macOS/Windows sin servicios extra.
+"""
+
+from __future__ import annotations
+
+import time
+from collections.abc import Callable, Iterable
+from pathlib import Path
+
+Snapshot = dict[Path, tuple[int, int]]
+
+
+def snapshot(paths: Iterable[Path]) -> Snapshot:
+    """Devuelve {path: (tamaño, mtime_ns)} de los archivos que existen."""
+    snap: Snapshot = {}
+    for p in paths:
+        try:
+            st = p.stat()
+        except OSError:
+            continue
+        snap[p] = (st.st_size, st.st_mtime_ns)
+    return snap
+
+
+def changed_paths(before: Snapshot, after: Snapshot) -> set[Path]:
+    """Archivos nuevos, modificados o eliminados entre dos snapshots."""
+    return {p for p in before.keys() | after.keys() if before.get(p) != after.get(p)}
+
+
+def watch(
+    list_paths: Callable[[], Iterable[Path]],
+    run: Callable[[set[Path]], None],
+    interval: float = 2.0,
+    log: Callable[[str], None] = print,
+) -> None:
+    """Llama a run(cambiados) cada vez que cambia algún archivo de list_paths().
+
+    Un cambio solo dispara run() cuando el snapshot se mantiene estable durante un
+    intervalo (evita procesar un .xlsx a medio copiar). La primera llamada recibe todos
+    los archivos. Tras cada run() se vuelve a tomar el snapshot, de modo que las salidas
+    que escribe el propio run() no lo vuelven a disparar. Termina con Ctrl+C.
+    """
+    prev: Snapshot | None = None
+    pending: Snapshot | None = snapshot(list_paths())
+    try:
+        while True:
+            snap = snapshot(list_paths())
+            if snap != prev:
+                if snap == pending:
+                    try:
+                        run(changed_paths(prev or {}, snap))
+                    except Exception as e:
+                        log(f"✗ Error en watch: {type(e).__name__}: {e}")
+                    prev = snapshot(list_paths())
+                    pending = None
+                    log(f"👀 Esperando cambios (cada {interval:g}s, Ctrl+C para salir)...")
+                else:
+                    pending = snap
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        log("Watch detenido")
@@ -4,7 +4,7 @@ Script simple para crear/editar usuarios en Moodle desde Excel
 """
 
 from pathlib import Path
-import openpyxl
+from functools import lru_cache
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.common.keys import Keys
@@ -14,9 +14,27 @@ from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.chrome.service import Service
 from webdriver_manager.chrome import ChromeDriverManager
 import time
+import threading
 from datetime import datetime
 import os
 
+import pandas as pd
+
+import email_registry
+import moodle_pages
+from adaptive_scheduler import AdaptiveLimiter, run_adaptive
+from check_emails_in_moodle_export import (
+    FIRSTNAME_TARGETS,
+    LASTNAME_TARGETS,
+    USERNAME_TARGETS,
+    _pick_column,
+    _pick_email_column,
+)
+from excel_io import read_rows
+from failure_capture import FailureCapture
+from run_metrics import RunMetrics
+from user_records import Registro, colapsar_por_email, motivos_rechazo, normalizar_nombre, nuevo_registro
+
 try:
     from dotenv import load_dotenv
 except Exception:  # pragma: no cover
@@ -28,6 +46,11 @@ RUN_TS = datetime.now().strftime("%Y%m%d_%H%M%S")
 LOG_DIR = BASE_DIR / "logs"
 LOG_DIR.mkdir(exist_ok=True)
 LOG_FILE = LOG_DIR / f"log_moodle_sync__{EXCEL_FILE.stem}__{RUN_TS}.txt"
+# Registro de emails procesados compartido con prepare_faltantes_por_email.py
+REGISTRY_FILE = BASE_DIR / ".cache" / "emails_registry.sqlite"
+# Capturas (URL, HTML, pantallazo) de las filas que terminan en error; directorio circular
+FAILURES_DIR = LOG_DIR / "failures"
+FAILURES_MAX_MB = float(os.getenv("MOODLE_FAILURES_MAX_MB", "100"))
 
 if load_dotenv is not None:
     load_dotenv(BASE_DIR / ".env")
@@ -36,11 +59,30 @@ MOODLE_BASE_URL = os.getenv("MOODLE_BASE_URL", "https://campus.edufamilia.com").
 MOODLE_ADMIN_USER = os.getenv("MOODLE_ADMIN_USER", "")
 MOODLE_ADMIN_PASSWORD = os.getenv("MOODLE_ADMIN_PASSWORD", "")
 
+# ===== CONCURRENCIA CONTRA MOODLE (servidor compartido) =====
+# Sesiones de Chrome en paralelo: arranca con el mínimo y sube/baja (AIMD) según la latencia
+# de las peticiones (páginas, clics, envíos de formulario) y los errores. Con MAX=1 se procesa secuencialmente, como siempre.
+CONCURRENCIA_MIN = int(os.getenv("MOODLE_MIN_CONCURRENCY", "1"))
+CONCURRENCIA_MAX = int(os.getenv("MOODLE_MAX_CONCURRENCY", "1"))
+MAX_PETICIONES_POR_SEGUNDO = float(os.getenv("MOODLE_MAX_RPS", "2"))  # peticiones/s, 0 = sin límite
+LATENCIA_OBJETIVO_S = float(os.getenv("MOODLE_TARGET_LATENCY", "4"))  # por encima, se reduce concurrencia
+# ============================================
+
 # ===== CONFIGURACIÓN DE FILAS A PROCESAR =====
 # Define qué filas del Excel procesará el script
 # Si FILAS_A_PROCESAR es None, se procesará desde FILA_INICIO hasta la última fila del Excel
 FILA_INICIO = 2  # Encabezados en fila 1
 FILAS_A_PROCESAR = None  # Procesa todas las filas desde FILA_INICIO hasta el final
+# Filas con el mismo email: "primera", "ultima" u "omitir_conflictos" (ver user_records.py)
+POLITICA_EMAILS_DUPLICADOS = "primera"
+# ============================================
+
+# ===== COLUMNAS DEL EXCEL =====
+# Se detectan por el texto de las cabeceras (fila 1), sin distinguir tildes ni mayúsculas,
+# como en check_emails_in_moodle_export.py. Para forzar una columna, indicar su cabecera o
+# su número (desde 1), p.ej. COLUMNAS = {"email": "Correo personal", "usuario": 6}
+COLUMNAS: dict[str, str | int] = {}
+CONTRASENA_TARGETS = ("contraseña", "password", "clave")
 # ============================================
 
 # Si un nombre/apellido viene TODO EN MAYÚSCULAS, Moodle no debería fallar por eso,
@@ -49,40 +91,18 @@ FILAS_A_PROCESAR = None  # Procesa todas las filas desde FILA_INICIO hasta el fi
 NORMALIZAR_MAYUSCULAS_A_TITULO = True
 
 
-def _solo_mayusculas(texto: str) -> bool:
-    letras = [c for c in texto if c.isalpha()]
-    return bool(letras) and all(c.isupper() for c in letras)
-
-
 def _normalizar_nombre(texto: str) -> str:
-    s = (texto or "").strip()
-    if not NORMALIZAR_MAYUSCULAS_A_TITULO:
-        return s
-    if _solo_mayusculas(s):
-        return s.title()
-    return s
+    return normalizar_nombre(texto, NORMALIZAR_MAYUSCULAS_A_TITULO)
 
 
 def _extraer_errores_moodle(driver) -> list[str]:
     """Intenta capturar mensajes de error visibles tras guardar un formulario."""
-    errores: list[str] = []
+    # Una sola petición (page_source) en vez de buscar elementos y leer su texto uno a uno;
+    # el análisis es el mismo que se prueba offline con moodle_fixtures.py.
     try:
-        candidates = driver.find_elements(
-            By.XPATH,
-            "//div[contains(@class,'alert-danger') or contains(@class,'error') or @role='alert']"
-            " | //span[contains(@class,'error')]"
-            " | //div[contains(@class,'invalid-feedback')]",
-        )
-        for el in candidates:
-            try:
-                t = (el.text or "").strip()
-            except Exception:
-                t = ""
-            if t and t not in errores:
-                errores.append(t)
+        return moodle_pages.extraer_errores(driver.page_source)
     except Exception:
         return []
-    return errores
 
 
 def _buscar_email_en_listado(driver, email: str) -> bool:
@@ -104,55 +124,153 @@ def _buscar_email_en_listado(driver, email: str) -> bool:
     campo_email.send_keys(Keys.RETURN)
     time.sleep(2)
 
-    # 1) Caso "No se encuentran usuarios"
-    if driver.find_elements(By.XPATH, "//*[contains(text(), 'No se encuentran usuarios')]"):
+    pagina = moodle_pages.parse(driver.page_source)
+
+    # 1) Caso "No se encuentran usuarios" / "No users found"
+    if moodle_pages.sin_resultados(pagina):
         return False
 
     # 2) Caso tabla con el email presente
-    if driver.find_elements(By.XPATH, f"//*[contains(normalize-space(.), '{email}')]"):
-        return True
+    return moodle_pages.email_en_listado(pagina, email)
 
-    return False
+# Último mensaje de error ('✗') de cada hilo, para anotarlo en la captura de fallos
+_ultimo_error = threading.local()
+# Fila que procesa cada hilo cuando hay varias sesiones en paralelo: sus líneas se entremezclan
+# en el log, así que se etiquetan con la fila
+_fila_actual = threading.local()
 
 def log_msg(mensaje):
     """Imprime mensaje con timestamp tanto en consola como en log"""
+    fila = getattr(_fila_actual, "fila", None)
+    if fila is not None and f"[Fila {fila}]" not in mensaje:
+        cuerpo = mensaje.lstrip("\n")
+        mensaje = f"{mensaje[:len(mensaje) - len(cuerpo)]}[Fila {fila}] {cuerpo}"
+    if "✗" in mensaje:
+        _ultimo_error.msg = mensaje.strip()
     ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     linea = f"[{ts}] {mensaje}"
     print(mensaje)
     with open(LOG_FILE, 'a', encoding='utf-8') as f:
         f.write(linea + '\n')
 
-def leer_registros_excel(filas):
-    """Lee los datos de los registros especificados del Excel"""
-    wb = openpyxl.load_workbook(EXCEL_FILE)
-    ws = wb.active
-    
+@lru_cache(maxsize=1)
+def _leer_hoja():
+    """Lee una sola vez la hoja activa de EXCEL_FILE (.xlsx, .csv o .parquet) vía excel_io"""
+    return read_rows(EXCEL_FILE)
+
+def resolver_columnas(cabeceras, columnas=None) -> dict[str, int]:
+    """Número de columna (desde 1) de cada campo según las cabeceras; `columnas` fuerza
+    campo -> cabecera o número. La contraseña es opcional (solo hace falta para crear)."""
+    columnas = columnas or {}
+    desconocidos = set(columnas) - {"apellidos", "nombre", "email", "usuario", "contrasena"}
+    if desconocidos:
+        raise KeyError(f"Campos desconocidos en COLUMNAS: {sorted(desconocidos)}")
+
+    nombres = ["" if c is None else str(c) for c in cabeceras]
+    targets = {
+        "apellidos": LASTNAME_TARGETS,
+        "nombre": FIRSTNAME_TARGETS,
+        "email": None,
+        "usuario": USERNAME_TARGETS,
+        "contrasena": CONTRASENA_TARGETS,
+    }
+    resueltas: dict[str, int] = {}
+    for campo, candidatos in targets.items():
+        forzada = columnas.get(campo)
+        if isinstance(forzada, int):
+            if not 1 <= forzada <= len(nombres):
+                raise KeyError(f"COLUMNAS[{campo!r}] = {forzada} fuera de rango (hay {len(nombres)} columnas)")
+            resueltas[campo] = forzada
+            continue
+        if forzada is not None:
+            col = _pick_column(nombres, (forzada,))
+        elif candidatos is None:
+            col = _pick_email_column(nombres)
+        else:
+            col = _pick_column(nombres, candidatos)
+        if col is None:
+            if campo == "contrasena" and forzada is None:
+                continue
+            raise KeyError(
+                f"No encuentro la columna de {campo!r} ({forzada or 'autodetección'}). "
+                f"Cabeceras: {[n for n in nombres if n]}"
+            )
+        resueltas[campo] = nombres.index(col) + 1
+
+    repetidas = [c for c in set(resueltas.values()) if list(resueltas.values()).count(c) > 1]
+    if repetidas:
+        campos = [k for k, v in resueltas.items() if v in repetidas]
+        raise KeyError(f"Varios campos usan la misma columna: {campos}")
+    return resueltas
+
+@lru_cache(maxsize=1)
+def _tabla():
+    """Las columnas de los campos para todas las filas de datos (índice = fila de Excel).
+    Las columnas se resuelven una sola vez por libro a partir de las cabeceras."""
+    hoja = _leer_hoja()
+    if not hoja:
+        raise KeyError(f"{EXCEL_FILE.name} está vacío")
+    columnas = resolver_columnas(hoja[0], COLUMNAS)
+    log_msg("Columnas: " + ", ".join(
+        f"{campo}={hoja[0][n - 1]!r} ({n})" for campo, n in columnas.items()
+    ))
+    df = pd.DataFrame(hoja[1:], index=range(2, len(hoja) + 1), columns=range(len(hoja[0])), dtype=object)
+    tabla = df[[n - 1 for n in columnas.values()]]
+    tabla.columns = list(columnas)
+    if "contrasena" not in tabla:
+        log_msg("⚠ Sin columna de contraseña: solo se podrán editar usuarios existentes")
+        tabla = tabla.assign(contrasena=None)
+    return tabla
+
+def leer_registros_excel(filas, metrics: RunMetrics | None = None):
+    """Lee los datos de los registros especificados del Excel.
+
+    Antes de crear los registros se validan todas las filas a la vez (campos obligatorios,
+    formato de email y de usuario): las que no se podrían sincronizar se anotan en el log
+    (y en `metrics` como 'rechazada') y no llegan al navegador. Las filas completamente
+    vacías se ignoran sin aviso."""
+    tabla = _tabla().reindex(filas)
+    vacias = tabla.isna().all(axis=1)
+    tabla = tabla[~vacias]
+    motivos = motivos_rechazo(tabla)
+    rechazadas = motivos[motivos != ""]
+    if len(rechazadas):
+        log_msg(f"\n⚠ Filas rechazadas antes de sincronizar: {len(rechazadas)}")
+        for fila, motivo in rechazadas.items():
+            log_msg(f"  - Fila {fila}: {motivo}")
+    if metrics is not None:
+        metrics.outcome("rechazada", len(rechazadas))
+
+    validas = tabla[motivos == ""]
+    validas = validas.astype(object).where(validas.notna(), None)
     registros = []
-    for fila in filas:
-        apellidos = ws.cell(fila, 1).value  # Columna 1: Apellidos
-        nombre = ws.cell(fila, 2).value     # Columna 2: Nombre
-        email = ws.cell(fila, 3).value      # Columna 3: Email
-        usuario = ws.cell(fila, 6).value    # Columna 6: Usuario
-        contrasena = ws.cell(fila, 7).value # Columna 7: Contraseña
-        
-        if nombre and apellidos and email and usuario:
-            registros.append({
-                'fila': fila,
-                'nombre': _normalizar_nombre(nombre),
-                'apellidos': _normalizar_nombre(apellidos),
-                'email': email.strip(),
-                'usuario': usuario.strip().lower(),
-                'contrasena': contrasena.strip() if contrasena else None
-            })
-    
+    for fila, apellidos, nombre, email, usuario, contrasena in zip(
+        validas.index, validas["apellidos"], validas["nombre"], validas["email"],
+        validas["usuario"], validas["contrasena"],
+    ):
+        registro = nuevo_registro(int(fila), apellidos, nombre, email, usuario, contrasena, _normalizar_nombre)
+        if registro is not None:
+            registros.append(registro)
     return registros
 
+def deduplicar_registros(registros, politica=None):
+    """Deja un registro por email (antes de abrir el navegador) y registra en el log las filas colapsadas"""
+    politica = politica or POLITICA_EMAILS_DUPLICADOS
+    unicos, colapsos = colapsar_por_email(registros, politica)
+    if colapsos:
+        log_msg(f"\n⚠ Emails repetidos en varias filas: {len(colapsos)} (política: {politica})")
+        for c in colapsos:
+            filas = ", ".join(str(r['fila']) for r in c.filas)
+            destino = f"se sincroniza la fila {c.elegido['fila']}" if c.elegido else "NO se sincroniza (revisar)"
+            log_msg(f"  - {c.email}: filas {filas} → {destino}")
+            if c.conflicto:
+                for r in c.filas:
+                    log_msg(f"      Fila {r['fila']}: {r['nombre']} {r['apellidos']}")
+    return unicos
+
 def obtener_filas_desde(inicio: int):
     """Devuelve lista de filas desde 'inicio' hasta el final del Excel"""
-    wb = openpyxl.load_workbook(EXCEL_FILE, read_only=True)
-    ws = wb.active
-    max_row = ws.max_row
-    wb.close()
+    max_row = len(_leer_hoja())
     filas = list(range(inicio, max_row + 1))
     log_msg(f"Rango detectado: fila {inicio} hasta fila {max_row} (total: {len(filas)} filas)")
     return filas
@@ -180,7 +298,7 @@ def login_moodle(driver):
     campo_password.send_keys(MOODLE_ADMIN_PASSWORD)
     
     # Click en Log in
-    login_btn = driver.find_element(By.XPATH, "//button[contains(text(), 'Log in')]")
+    login_btn = driver.find_element(By.XPATH, moodle_pages.xpath_texto("button", moodle_pages.LOGIN_TEXTS))
     login_btn.click()
     
     time.sleep(4)
@@ -226,11 +344,11 @@ def procesar_usuario(driver, registro, es_primero=False):
         time.sleep(3)
         
         # 5. Verificar si encuentra usuarios (sin usar except genérico)
-        if driver.find_elements(By.XPATH, "//*[contains(text(), 'No se encuentran usuarios')]"):
+        if moodle_pages.sin_resultados(driver.page_source):
             log_msg(f"  → Usuario NO existe. Creando...")
 
             boton_crear = wait.until(
-                EC.element_to_be_clickable((By.XPATH, "//button[contains(text(), 'Crear un nuevo usuario')]"))
+                EC.element_to_be_clickable((By.XPATH, moodle_pages.xpath_texto("button", moodle_pages.CREATE_USER_TEXTS)))
             )
             boton_crear.click()
             time.sleep(2)
@@ -505,6 +623,87 @@ def editar_usuario_moodle(driver, fila, nombre, apellidos, email):
         log_msg(f"  ✗ Error: {str(e)[:100]}")
         return False
 
+def crear_driver():
+    """Arranca Chrome con la configuración usada para Moodle"""
+    chrome_options = Options()
+    chrome_options.add_argument("--disable-blink-features=AutomationControlled")
+    chrome_options.add_argument("user-agent=Mozilla/5.0")
+    return webdriver.Chrome(service=Service(ChromeDriverManager().install()), options=chrome_options)
+
+def crear_captura() -> FailureCapture:
+    """Captura de fallos en FAILURES_DIR (hay que cerrarla con close() al terminar)"""
+    return FailureCapture(FAILURES_DIR, int(FAILURES_MAX_MB * 1024 * 1024))
+
+def _procesar_con_captura(driver, registro, es_primero, capture: FailureCapture | None):
+    """procesar_usuario + captura del navegador solo si el resultado es 'error'"""
+    _ultimo_error.msg = ""
+    result = procesar_usuario(driver, registro, es_primero)
+    if result == "error" and capture is not None:
+        capture.capture(driver, registro['fila'], registro['email'], _ultimo_error.msg)
+    return result
+
+def crear_limitador(max_concurrencia: int | None = None) -> AdaptiveLimiter:
+    """Limitador AIMD con la configuración de CONCURRENCIA_* (max_concurrencia la sustituye)"""
+    maximo = max_concurrencia or CONCURRENCIA_MAX
+    return AdaptiveLimiter(
+        min_concurrency=min(CONCURRENCIA_MIN, maximo),
+        max_concurrency=maximo,
+        max_rps=MAX_PETICIONES_POR_SEGUNDO,
+        target_latency=LATENCIA_OBJETIVO_S,
+        log=log_msg,
+    )
+
+def sincronizar_concurrente(
+    abrir_sesion, registros: list[Registro], registry, source: str, limiter: AdaptiveLimiter,
+    metrics: RunMetrics | None = None, capture: FailureCapture | None = None,
+) -> list[tuple[Registro, str]]:
+    """Crea/edita cada registro en Moodle repartiéndolos entre varias sesiones de Chrome
+    según el limitador AIMD, y marca en el registro de emails los confirmados.
+    abrir_sesion() debe devolver un driver con sesión iniciada (y pasado por
+    limiter.instrument_driver para medir y limitar las peticiones al servidor). Devuelve
+    (registro, resultado) con 'created'/'edited'/'error', en el orden de `registros`.
+    Si se pasa `metrics`, cuenta cada resultado; con `capture`, guarda el estado del
+    navegador de las filas con error."""
+    log_msg(f"\nProcesando {len(registros)} registros (concurrencia {limiter.min_concurrency}-{limiter.max_concurrency}, "
+            f"máx. {limiter.max_rps:g} peticiones/s)...")
+    for r in registros:
+        log_msg(f"  - Fila {r['fila']}: {r['nombre']} {r['apellidos']}")
+
+    def procesar(driver, registro, es_primero):
+        _fila_actual.fila = registro['fila'] if limiter.max_concurrency > 1 else None
+        try:
+            result = _procesar_con_captura(driver, registro, es_primero, capture)
+        finally:
+            _fila_actual.fila = None
+        limiter.observe(None, result != "error")
+        time.sleep(1)
+        return result
+
+    resultados: list = [None] * len(registros)
+    for idx, registro, result, error in run_adaptive(registros, abrir_sesion, procesar, limiter, lambda d: d.quit()):
+        if error is not None:
+            log_msg(f"  ✗ [Fila {registro['fila']}] Error de sesión: {str(error)[:120]}")
+            result = "error"
+        resultados[idx] = (registro, result)
+        if metrics is not None:
+            metrics.outcome(result)
+        if result in ("created", "edited"):
+            email_registry.register_emails(
+                registry, [registro['email'].lower()], source, email_registry.ESTADO_CONFIRMADO
+            )
+
+    _log_resumen(resultados)
+    return resultados
+
+def _log_resumen(resultados):
+    created = sum(1 for _, r in resultados if r == "created")
+    edited = sum(1 for _, r in resultados if r == "edited")
+    errors = len(resultados) - created - edited
+    log_msg("\n" + "=" * 80)
+    log_msg("✓ Proceso completado")
+    log_msg(f"Resumen: creados={created}, editados={edited}, errores={errors}, total={len(resultados)}")
+    log_msg("=" * 80)
+
 def main():
     """Función principal"""
     log_msg("=" * 80)
@@ -513,47 +712,43 @@ def main():
     log_msg(f"Excel: {EXCEL_FILE.name}")
     log_msg(f"Log: {LOG_FILE.name}")
     
-    # Configurar Chrome
-    chrome_options = Options()
-    chrome_options.add_argument("--disable-blink-features=AutomationControlled")
-    chrome_options.add_argument("user-agent=Mozilla/5.0")
-    driver = webdriver.Chrome(service=Service(ChromeDriverManager().install()), options=chrome_options)
+    metrics = RunMetrics("moodle_excel_sync", EXCEL_FILE.name)
+    limiter = crear_limitador()
+    capture = crear_captura()
+    registry = email_registry.open_registry(REGISTRY_FILE)
+
+    def abrir_sesion():
+        driver = metrics.instrument_driver(limiter.instrument_driver(crear_driver()))
+        try:
+            with metrics.phase("login"):
+                login_moodle(driver)
+        except Exception:
+            driver.quit()
+            raise
+        return driver
     
     try:
-        # Login
-        login_moodle(driver)
-        
         # Procesar registros según configuración
-        filas_a_procesar = FILAS_A_PROCESAR or obtener_filas_desde(FILA_INICIO)
-        registros = leer_registros_excel(filas_a_procesar)
-        
-        log_msg(f"\nProcesando {len(registros)} registros...")
-        for r in registros:
-            log_msg(f"  - Fila {r['fila']}: {r['nombre']} {r['apellidos']}")
-        
-        created = 0
-        edited = 0
-        errors = 0
-        for idx, registro in enumerate(registros):
-            es_primero = (idx == 0)
-            result = procesar_usuario(driver, registro, es_primero)
-            if result == "created":
-                created += 1
-            elif result == "edited":
-                edited += 1
-            else:
-                errors += 1
-            time.sleep(1)
-        
-        log_msg("\n" + "=" * 80)
-        log_msg("✓ Proceso completado")
-        log_msg(f"Resumen: creados={created}, editados={edited}, errores={errors}, total={len(registros)}")
-        log_msg("=" * 80)
+        with metrics.phase("leer"):
+            filas_a_procesar = FILAS_A_PROCESAR or obtener_filas_desde(FILA_INICIO)
+            registros = leer_registros_excel(filas_a_procesar, metrics)
+            leidos = len(registros)
+            registros = deduplicar_registros(registros)
+        metrics.inc("rows_read", len(filas_a_procesar))
+        metrics.outcome("duplicado", leidos - len(registros))
+        
+        # Login (una sesión por cada hilo que llegue a usarse) y sincronización
+        with metrics.phase("sincronizar"):
+            sincronizar_concurrente(abrir_sesion, registros, registry, EXCEL_FILE.name, limiter, metrics, capture)
         
     except Exception as e:
         log_msg(f"\n✗ Error general: {e}")
     finally:
-        driver.quit()
+        registry.close()
+        capture.close()
+        if capture.saved:
+            log_msg(f"Capturas de fallos: {capture.saved} en {FAILURES_DIR}")
+        log_msg(f"Métricas: {metrics.write().name}")
 
 if __name__ == "__main__":
     main()
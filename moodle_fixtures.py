@@ -0,0 +1,177 @@
+"""Páginas de Moodle grabadas (fixtures) para probar moodle_pages.py sin navegador.
+
+    python moodle_fixtures.py                       # replay: comprueba todas las fixtures
+    python moodle_fixtures.py record --email alguien@dominio.com --locale es en
+
+`replay` analiza cada HTML de fixtures/moodle/ con moodle_pages (sin_resultados,
+email_en_listado, extraer_errores) y lo compara con lo esperado en fixtures.json.
+Sale con código 2 si alguna no coincide.
+
+`record` inicia sesión con las credenciales de .env (como moodle_excel_sync.py) y guarda,
+para cada idioma (?lang=es|en), tres páginas reales:
+- listado filtrado por un email que no existe (sin resultados);
+- listado filtrado por --email (un usuario que sí existe);
+- formulario de alta enviado vacío (errores de validación; no crea ningún usuario).
+Lo esperado se guarda a partir de lo que se sabe de cada página; si el análisis actual no
+coincide, se avisa al grabar. Las páginas grabadas contienen datos reales de usuarios:
+revisarlas antes de subirlas al repositorio.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import time
+from datetime import datetime
+from pathlib import Path
+
+import moodle_pages
+
+BASE_DIR = Path(__file__).resolve().parent
+FIXTURES_DIR = BASE_DIR / "fixtures" / "moodle"
+MANIFEST = FIXTURES_DIR / "fixtures.json"
+
+
+def _load_manifest() -> dict:
+    if not MANIFEST.exists():
+        return {}
+    return json.loads(MANIFEST.read_text(encoding="utf-8"))
+
+
+def _save_manifest(manifest: dict) -> None:
+    MANIFEST.write_text(json.dumps(manifest, ensure_ascii=False, indent=2, sort_keys=True) + "\n", encoding="utf-8")
+
+
+def analizar(html: str, emails: list[str]) -> dict:
+    """Lo que la sincronización deduciría de la página."""
+    page = moodle_pages.parse(html)
+    return {
+        "sin_resultados": moodle_pages.sin_resultados(page),
+        "emails": {e: moodle_pages.email_en_listado(page, e) for e in emails},
+        "errores": moodle_pages.extraer_errores(page),
+    }
+
+
+def _diferencias(esperado: dict, obtenido: dict) -> list[str]:
+    diffs = []
+    for key in ("sin_resultados", "emails", "errores"):
+        if key in esperado and esperado[key] != obtenido[key]:
+            diffs.append(f"{key}: esperado {esperado[key]!r}, obtenido {obtenido[key]!r}")
+    return diffs
+
+
+def replay(args: argparse.Namespace) -> int:
+    manifest = _load_manifest()
+    if not manifest:
+        print(f"No hay fixtures en {MANIFEST}")
+        return 0
+
+    fallos = 0
+    t_total = 0.0
+    for name, esperado in sorted(manifest.items()):
+        path = FIXTURES_DIR / name
+        if not path.exists():
+            print(f"✗ {name}: no existe el archivo")
+            fallos += 1
+            continue
+        html = path.read_text(encoding="utf-8")
+        t0 = time.perf_counter()
+        obtenido = analizar(html, list(esperado.get("emails", {})))
+        elapsed = time.perf_counter() - t0
+        t_total += elapsed
+        diffs = _diferencias(esperado, obtenido)
+        origen = esperado.get("origen", "")
+        if diffs:
+            fallos += 1
+            print(f"✗ {name} ({origen}, {elapsed * 1000:.1f} ms)")
+            for d in diffs:
+                print(f"    {d}")
+        else:
+            print(f"✓ {name} ({origen}, {elapsed * 1000:.1f} ms)")
+
+    print(f"\n{len(manifest) - fallos}/{len(manifest)} fixtures OK en {t_total * 1000:.1f} ms")
+    return 0 if not fallos else 2
+
+
+def _quitar_filtros(driver, sync) -> None:
+    """Los filtros de admin/user.php se acumulan en la sesión: se quitan antes de cada búsqueda."""
+    driver.get(f"{sync.MOODLE_BASE_URL}/admin/user.php")
+    time.sleep(2)
+    try:
+        driver.find_element(sync.By.ID, "id_removeall").click()
+        time.sleep(1)
+    except Exception:
+        pass
+
+
+def record(args: argparse.Namespace) -> int:
+    import moodle_excel_sync as sync
+
+    manifest = _load_manifest()
+    inexistente = f"no-existe-{datetime.now().strftime('%Y%m%d%H%M%S')}@example.invalid"
+    driver = sync.crear_driver()
+    try:
+        sync.login_moodle(driver)
+        for locale in args.locale:
+            # ?lang= cambia el idioma de la sesión para las páginas siguientes
+            driver.get(f"{sync.MOODLE_BASE_URL}/admin/user.php?lang={locale}")
+            time.sleep(2)
+
+            paginas = []
+            _quitar_filtros(driver, sync)
+            sync._buscar_email_en_listado(driver, inexistente)
+            paginas.append(("listado_sin_resultados", driver.page_source, driver.current_url,
+                            {"sin_resultados": True, "emails": {inexistente: False}, "errores": []}))
+
+            _quitar_filtros(driver, sync)
+            sync._buscar_email_en_listado(driver, args.email)
+            paginas.append(("listado_con_email", driver.page_source, driver.current_url,
+                            {"sin_resultados": False, "emails": {args.email: True}, "errores": []}))
+
+            driver.get(f"{sync.MOODLE_BASE_URL}/user/editadvanced.php?id=-1")
+            time.sleep(2)
+            submit = driver.find_element(sync.By.ID, "id_submitbutton")
+            driver.execute_script("arguments[0].click();", submit)
+            time.sleep(3)
+            paginas.append(("formulario_errores", driver.page_source, driver.current_url, {"sin_resultados": False}))
+
+            out_dir = FIXTURES_DIR / locale
+            out_dir.mkdir(parents=True, exist_ok=True)
+            for nombre, html, url, conocido in paginas:
+                name = f"{locale}/grabado_{nombre}.html"
+                (FIXTURES_DIR / name).write_text(html, encoding="utf-8")
+                obtenido = analizar(html, list(conocido.get("emails", {})))
+                diffs = _diferencias(conocido, obtenido)
+                if nombre == "formulario_errores" and not obtenido["errores"]:
+                    diffs.append("errores: se esperaba al menos un error de validación")
+                # Los errores concretos se guardan tal cual salen (revisar en el diff)
+                manifest[name] = {**conocido, "errores": obtenido["errores"], "origen": "grabado", "url": url}
+                print(f"{'⚠' if diffs else '✓'} {name}")
+                for d in diffs:
+                    print(f"    {d}")
+    finally:
+        driver.quit()
+
+    _save_manifest(manifest)
+    print(f"Manifest: {MANIFEST}")
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Fixtures HTML de Moodle para probar moodle_pages.py sin navegador")
+    sub = parser.add_subparsers(dest="cmd")
+
+    p = sub.add_parser("replay", help="Comprueba las fixtures (por defecto)")
+    p.set_defaults(func=replay)
+
+    p = sub.add_parser("record", help="Graba páginas reales de Moodle como fixtures (requiere .env)")
+    p.add_argument("--email", required=True, help="Email de un usuario que existe en Moodle")
+    p.add_argument("--locale", nargs="+", default=["es", "en"], help="Idiomas de la interfaz a grabar")
+    p.set_defaults(func=record)
+
+    args = parser.parse_args()
+    return getattr(args, "func", replay)(args)
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
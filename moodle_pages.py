@@ -0,0 +1,181 @@
+"""Interpretación del HTML de las páginas de Moodle, sin navegador.
+
+La sincronización decide a partir del HTML (driver.page_source) si un filtro de usuarios no
+devolvió resultados, si un email aparece en el listado y qué errores mostró un formulario.
+Con funciones puras sobre el HTML, las mismas decisiones se prueban offline con páginas
+grabadas (moodle_fixtures.py) en milisegundos, y funcionan con la interfaz en español y en
+inglés.
+
+El "DOM" es mínimo (html.parser de la librería estándar): etiquetas, atributos y texto, y
+se ignoran <script>/<style> y los elementos ocultos (atributo hidden, display:none, d-none).
+"""
+
+from __future__ import annotations
+
+import re
+from dataclasses import dataclass, field
+from html.parser import HTMLParser
+
+# Textos de la interfaz por idioma (la cadena de Moodle entre paréntesis)
+NO_USERS_TEXTS = (
+    "No se encuentran usuarios",  # es: nousersfound
+    "Nada que mostrar",  # es: nothingtodisplay (listado con report builder, Moodle 4.3+)
+    "No users found",  # en: nousersfound
+    "Nothing to display",  # en: nothingtodisplay
+)
+CREATE_USER_TEXTS = ("Crear un nuevo usuario", "Add a new user")
+LOGIN_TEXTS = ("Log in", "Acceder")
+
+VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param", "source", "track", "wbr"}
+SKIP_TAGS = {"script", "style", "template", "noscript"}
+
+
+@dataclass(eq=False)
+class Node:
+    tag: str
+    attrs: dict[str, str]
+    parent: Node | None = field(default=None, repr=False)
+    children: list[Node | str] = field(default_factory=list, repr=False)
+
+    @property
+    def classes(self) -> str:
+        return self.attrs.get("class", "")
+
+    @property
+    def hidden(self) -> bool:
+        style = self.attrs.get("style", "").replace(" ", "").lower()
+        return (
+            "hidden" in self.attrs
+            or "display:none" in style
+            or "d-none" in self.classes.split()
+            or self.tag in SKIP_TAGS
+        )
+
+    def iter(self):
+        """Este nodo y todos sus descendientes elemento, en orden de documento."""
+        yield self
+        for c in self.children:
+            if isinstance(c, Node):
+                yield from c.iter()
+
+    def own_texts(self) -> list[str]:
+        """Nodos de texto hijos directos (lo que evalúa text() en XPath)."""
+        return [c for c in self.children if isinstance(c, str)]
+
+    def text(self) -> str:
+        """Texto visible del elemento con espacios normalizados (como WebElement.text)."""
+        if self.hidden:
+            return ""
+        parts: list[str] = []
+        for c in self.children:
+            parts.append(c if isinstance(c, str) else f" {c.text()} ")
+        return " ".join("".join(parts).split())
+
+    def visible(self) -> bool:
+        node: Node | None = self
+        while node is not None:
+            if node.hidden:
+                return False
+            node = node.parent
+        return True
+
+
+class _TreeBuilder(HTMLParser):
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=True)
+        self.root = Node("#document", {})
+        self.current = self.root
+
+    def handle_starttag(self, tag, attrs):
+        node = Node(tag, {k: v or "" for k, v in attrs}, self.current)
+        self.current.children.append(node)
+        if tag not in VOID_TAGS:
+            self.current = node
+
+    def handle_startendtag(self, tag, attrs):
+        self.current.children.append(Node(tag, {k: v or "" for k, v in attrs}, self.current))
+
+    def handle_endtag(self, tag):
+        # Cierra hasta la etiqueta abierta correspondiente; una etiqueta de cierre sin
+        # apertura (HTML mal formado) se ignora.
+        node: Node | None = self.current
+        while node is not None and node.tag != tag:
+            node = node.parent
+        if node is not None and node.parent is not None:
+            self.current = node.parent
+
+    def handle_data(self, data):
+        self.current.children.append(data)
+
+
+def parse(html: str) -> Node:
+    builder = _TreeBuilder()
+    builder.feed(html)
+    builder.close()
+    return builder.root
+
+
+def _as_tree(page: str | Node) -> Node:
+    return page if isinstance(page, Node) else parse(page)
+
+
+def extraer_errores(page: str | Node) -> list[str]:
+    """Mensajes de error visibles tras guardar un formulario (sin repetir, en orden).
+
+    Mismos elementos que buscaba la sincronización: div con clase *alert-danger*/*error* o
+    role="alert", span con clase *error* y div con clase *invalid-feedback*.
+    """
+    errores: list[str] = []
+    for node in _as_tree(page).iter():
+        cls = node.classes
+        es_error = (
+            (node.tag == "div" and ("alert-danger" in cls or "error" in cls or node.attrs.get("role") == "alert"))
+            or (node.tag == "span" and "error" in cls)
+            or (node.tag == "div" and "invalid-feedback" in cls)
+        )
+        if not es_error or not node.visible():
+            continue
+        t = node.text()
+        if t and t not in errores:
+            errores.append(t)
+    return errores
+
+
+def sin_resultados(page: str | Node) -> bool:
+    """True si el listado de usuarios muestra el aviso de "no hay usuarios" (es o en)."""
+    for node in _as_tree(page).iter():
+        textos = node.own_texts()
+        if textos and any(t in s for s in textos for t in NO_USERS_TEXTS) and node.visible():
+            return True
+    return False
+
+
+def email_en_listado(page: str | Node, email: str) -> bool:
+    """True si `email` aparece completo en alguna tabla de la página (sin distinguir mayúsculas).
+
+    Solo se mira dentro de <table> (el listado, también con report builder) porque el propio
+    filtro activo ("Dirección de correo contiene ...") muestra el email buscado: una página
+    sin tablas no lista ningún usuario.
+    """
+    needle = " ".join((email or "").split()).casefold()
+    if not needle:
+        return False
+    # Email completo: que "ana@x.com" no cuente como encontrado por "mariana@x.com"
+    patron = re.compile(rf"(?<![\w.+'-]){re.escape(needle)}(?![\w.-])")
+    return any(patron.search(n.text().casefold()) for n in _as_tree(page).iter() if n.tag == "table")
+
+
+def xpath_literal(value: str) -> str:
+    """Literal XPath 1.0 para cualquier texto (XPath no tiene escape de comillas)."""
+    if "'" not in value:
+        return f"'{value}'"
+    if '"' not in value:
+        return f'"{value}"'
+    partes = re.split("(')", value)
+    return "concat(" + ", ".join('"\'"' if p == "'" else f"'{p}'" for p in partes if p) + ")"
+
+
+def xpath_texto(tag: str, textos: tuple[str, ...]) -> str:
+    """XPath de un elemento `tag` cuyo texto contiene cualquiera de `textos` (p.ej. es/en)."""
+    cond = " or ".join(f"contains(normalize-space(.), {xpath_literal(t)})" for t in textos)
+    return f"//{tag}[{cond}]"
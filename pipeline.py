@@ -0,0 +1,241 @@
+from __future__ import annotations
+
+import argparse
+from collections.abc import Callable
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+
+import email_registry
+import prepare_faltantes_por_email as prep
+from excel_io import ENGINES, write_table
+from fetch_moodle_users import fetch_snapshot
+from run_metrics import RunMetrics
+from user_records import Registro, motivos_rechazo, normalizar_nombre, nuevo_registro
+
+
+def registros_desde_df(
+    df: pd.DataFrame, log: Callable[[str], None] = print, metrics: RunMetrics | None = None
+) -> list[Registro]:
+    """Convierte la salida de prep.build_faltantes en registros para la sincronización.
+
+    'fila' es la fila del Excel de entrada (índice + 2), para poder rastrear cada usuario.
+    Igual que en leer_registros_excel, las filas se validan antes (user_records.motivos_rechazo)
+    y las rechazadas se anotan en el log (y en `metrics` como 'rechazada') sin llegar al navegador.
+    """
+    campos = df.rename(
+        columns={
+            prep.COL_APELLIDOS: "apellidos",
+            prep.COL_NOMBRE: "nombre",
+            prep.COL_CORREO: "email",
+            prep.COL_USUARIO: "usuario",
+        }
+    )
+    motivos = motivos_rechazo(campos)
+    rechazadas = motivos[motivos != ""]
+    if len(rechazadas):
+        log(f"⚠ Filas rechazadas antes de sincronizar: {len(rechazadas)}")
+        for idx, motivo in rechazadas.items():
+            log(f"  - Fila {int(idx) + 2}: {motivo}")
+    if metrics is not None:
+        metrics.outcome("rechazada", len(rechazadas))
+
+    df = df[motivos == ""]
+    values = df.astype(object).where(df.notna(), None)
+    registros = []
+    for idx, row in zip(values.index, values.itertuples(index=False, name=None)):
+        fila = dict(zip(values.columns, row))
+        registro = nuevo_registro(
+            int(idx) + 2,
+            fila[prep.COL_APELLIDOS],
+            fila[prep.COL_NOMBRE],
+            fila[prep.COL_CORREO],
+            fila[prep.COL_USUARIO],
+            fila[prep.COL_CONTRASENA],
+            normalizar_nombre,
+        )
+        if registro is not None:
+            registros.append(registro)
+    return registros
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description=(
+            "Intake completo en memoria: preparar faltantes (+ Usuario/Contraseña) -> sincronizar "
+            "con Moodle -> verificar. Los Excel intermedios solo se escriben si se piden."
+        )
+    )
+    parser.add_argument("--input", required=True, help="Excel de registros de entrada (en ./excel)")
+    parser.add_argument(
+        "--compare",
+        default=[],
+        nargs="*",
+        help="Excel ya procesados para excluir emails (se importan al registro la primera vez)",
+    )
+    parser.add_argument(
+        "--write-prepared",
+        nargs="?",
+        const="",
+        default=None,
+        metavar="ARCHIVO",
+        help="Guarda también los faltantes preparados (.xlsx/.csv/.parquet; por defecto <input>_faltantes_rellenado.xlsx)",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Solo prepara y muestra lo que se sincronizaría (no abre el navegador)",
+    )
+    parser.add_argument(
+        "--csv",
+        type=Path,
+        default=None,
+        help=(
+            "Export CSV de Moodle para verificar al final que los emails preparados están en Moodle; "
+            "debe ser posterior a la sincronización ('latest' = descarga un snapshot nuevo con "
+            "fetch_moodle_users.py al terminar de sincronizar)"
+        ),
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=None,
+        metavar="N",
+        help="Máximo de sesiones de Chrome en paralelo (ajuste AIMD; por defecto: MOODLE_MAX_CONCURRENCY o 1)",
+    )
+    parser.add_argument(
+        "--registry",
+        type=Path,
+        default=None,
+        help="Registro SQLite de emails ya procesados (por defecto: ./.cache/emails_registry.sqlite)",
+    )
+    parser.add_argument(
+        "--excel-engine",
+        choices=ENGINES,
+        default=None,
+        help="Motor de lectura .xlsx (por defecto: calamine si está instalado, si no openpyxl)",
+    )
+    args = parser.parse_args()
+    # 'latest' se resuelve después de sincronizar: un snapshot anterior no tendría los
+    # usuarios creados en esta ejecución.
+    csv_latest = args.csv is not None and str(args.csv) == "latest"
+    if args.csv is not None and not csv_latest and not args.csv.exists():
+        raise SystemExit(f"No existe el export CSV: {args.csv}")
+
+    base_dir = Path(__file__).resolve().parent
+    excel_dir = base_dir / "excel"
+    input_xlsx = (excel_dir / args.input).resolve()
+    compare_xlsx = [(excel_dir / p).resolve() for p in args.compare]
+    prepared_name = args.write_prepared or f"{Path(args.input).stem}_faltantes_rellenado.xlsx"
+    prepared_path = (excel_dir / prepared_name).resolve()
+
+    log_dir = base_dir / "logs"
+    log_dir.mkdir(exist_ok=True)
+    log_file = log_dir / f"log_pipeline__{input_xlsx.stem}__{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
+
+    def log(line: str) -> None:
+        print(line)
+        try:
+            with log_file.open("a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        except Exception:
+            pass
+
+    metrics = RunMetrics("pipeline", input_xlsx.name)
+    registry = email_registry.open_registry(args.registry or base_dir / ".cache" / "emails_registry.sqlite")
+    try:
+        # 1) Preparar + completar Usuario/Contraseña (en memoria)
+        log("=== 1/3 Preparar faltantes")
+        log(f"Input: {input_xlsx.name}")
+        with metrics.phase("preparar"):
+            df_in = prep.read_input(input_xlsx, log, args.excel_engine)
+            emails = prep.normalize_email_series(df_in[prep.COL_CORREO]).dropna().unique().tolist()
+            existing = prep.load_existing_emails(
+                emails, compare_xlsx, prepared_path.name, log, registry=registry, engine=args.excel_engine,
+                read_only=args.dry_run,
+            )
+            df_out = prep.build_faltantes(df_in, existing, input_xlsx.name, log)
+            registros = registros_desde_df(df_out, log, metrics)
+        metrics.inc("rows_read", len(df_in))
+        log(f"Registros sincronizables: {len(registros)} de {len(df_out)} faltantes")
+
+        if args.write_prepared is not None:
+            write_table(df_out, prepared_path, sheet_name="Usuarios")
+            log(f"Artefacto: {prepared_path.name}")
+
+        if args.dry_run:
+            metrics.outcome("preparado", len(registros))
+            for r in registros:
+                log(f"  - Fila {r['fila']}: {r['nombre']} {r['apellidos']} <{r['email']}> usuario={r['usuario']}")
+            log("Dry-run: no se sincroniza con Moodle (el registro de emails no se modifica)")
+            return 0
+
+        # 2) Sincronizar (mismo código que moodle_excel_sync.py, sin releer Excel)
+        log("=== 2/3 Sincronizar con Moodle")
+        import moodle_excel_sync as sync
+
+        sync.LOG_FILE = log_file
+        # build_faltantes ya deja un registro por email; se aplica igualmente la política
+        # de duplicados de la sincronización para que el flujo de registros sea el mismo.
+        registros = sync.deduplicar_registros(registros)
+        resultados = []
+        if registros:
+            limiter = sync.crear_limitador(args.concurrency)
+            capture = sync.crear_captura()
+
+            def abrir_sesion():
+                driver = metrics.instrument_driver(limiter.instrument_driver(sync.crear_driver()))
+                try:
+                    sync.login_moodle(driver)
+                except Exception:
+                    driver.quit()
+                    raise
+                return driver
+
+            try:
+                with metrics.phase("sincronizar"):
+                    resultados = sync.sincronizar_concurrente(
+                        abrir_sesion, registros, registry, prepared_path.name, limiter, metrics, capture
+                    )
+            finally:
+                capture.close()
+            if capture.saved:
+                log(f"Capturas de fallos: {capture.saved} en {sync.FAILURES_DIR}")
+
+        # Al registro solo llegan los creados/editados (confirmado, desde sincronizar_concurrente):
+        # los que terminan en error o se rechazan siguen sin registrar y salen en el próximo intake.
+        if args.write_prepared is not None:
+            email_registry.mark_imported(registry, prepared_path)
+
+        # 3) Verificar: procesar_usuario ya comprueba cada alta/edición en el listado de
+        # Moodle; opcionalmente se contrasta además con un export CSV.
+        log("=== 3/3 Verificar")
+        fallidos = [r for r, result in resultados if result not in ("created", "edited")]
+        for r in fallidos:
+            log(f"  ✗ Fila {r['fila']}: {r['email']}")
+        if csv_latest:
+            # Snapshot nuevo, con los usuarios recién creados (sin sincronizados no hay nada que verificar)
+            args.csv = None
+            if resultados:
+                with metrics.phase("descargar_usuarios"):
+                    args.csv = fetch_snapshot(log=log)
+        if args.csv is not None:
+            import check_emails_in_moodle_export as checker
+
+            with metrics.phase("verificar"):
+                emails_csv = checker._emails_from_csv(args.csv)
+                ausentes = sorted({r["email"].lower() for r, _ in resultados} - emails_csv)
+            log(f"Emails sincronizados ausentes en {args.csv.name}: {len(ausentes)}")
+            for e in ausentes[:50]:
+                log(f"  - {e}")
+        log(f"Resumen pipeline: {len(resultados) - len(fallidos)} OK, {len(fallidos)} con error")
+        log(f"Log: {log_file.name}")
+        return 0 if not fallidos else 2
+    finally:
+        registry.close()
+        log(f"Métricas: {metrics.write().name}")
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,10 +1,19 @@
 from __future__ import annotations
 
 import argparse
+import sqlite3
+from collections.abc import Callable
 from pathlib import Path
 from datetime import datetime
 import pandas as pd
 
+import email_registry
+from check_emails_in_moodle_export import _emails_from_csv
+from excel_io import ENGINES, read_table, write_table
+from fetch_moodle_users import export_paths, resolve_export
+from file_watch import snapshot, watch
+from run_metrics import RunMetrics
+
 COL_APELLIDOS = "Apellidos"
 COL_NOMBRE = "Nombre"
 COL_CORREO = "Correo"
@@ -24,39 +33,212 @@ OUTPUT_COLUMNS = [
 ]
 
 
-def normalize_email(value) -> str | None:
-    if value is None or (isinstance(value, float) and pd.isna(value)):
-        return None
-    s = str(value).strip().lower()
-    if not s:
-        return None
-    return s
+def _text_series(s: pd.Series) -> pd.Series:
+    """Equivalente vectorizado de `str(v).strip() if pd.notna(v) else ""`."""
+    return s.astype(object).where(s.notna(), "").astype(str).str.strip()
+
+
+def normalize_email_series(s: pd.Series) -> pd.Series:
+    """Versión vectorizada de normalize_email: minúsculas sin espacios, vacíos/NaN -> NaN."""
+    s = _text_series(s).str.lower()
+    return s.where(s != "")
+
 
+def build_usuario_contrasena(df: pd.DataFrame) -> tuple[pd.Series, pd.Series, int, int]:
+    """Deriva Usuario y Contraseña para todas las filas a la vez (mismas reglas que
+    email_local_part y first_name). Devuelve (usuarios, contraseñas, emails_inválidos,
+    nombres_problemáticos); las filas problemáticas quedan con "".
+    """
+    correo = _text_series(df[COL_CORREO])
+    nombre = _text_series(df[COL_NOMBRE])
 
-def email_local_part(email: str) -> str:
-    email = (email or "").strip()
-    if "@" not in email:
-        raise ValueError(f"Email inválido (sin @): {email!r}")
-    return email.split("@", 1)[0].strip()
+    has_at = correo.str.contains("@", regex=False)
+    usuarios = correo.str.split("@", n=1).str[0].str.strip().where(has_at, "")
 
+    primero = nombre.str.split(n=1).str[0].fillna("")
+    contras = (primero + "+A1+-").where(nombre != "", "")
 
-def first_name(nombre: str) -> str:
-    nombre = (nombre or "").strip()
-    if not nombre:
-        raise ValueError("Nombre vacío, no puedo generar contraseña.")
-    return nombre.split()[0]
+    invalid_email = int((~has_at).sum())
+    empty_name = int(((nombre != "") & (primero == "")).sum())
+    return usuarios, contras, invalid_email, empty_name
 
 
-def read_emails_from_excel(path: Path) -> set[str]:
-    df = pd.read_excel(path)
+def read_emails_from_excel(path: Path, engine: str | None = None) -> set[str]:
+    df = read_table(path, engine)
     if COL_CORREO not in df.columns:
         raise KeyError(f"No encuentro la columna {COL_CORREO!r} en {path.name}. Columnas: {list(df.columns)}")
-    emails = set()
-    for v in df[COL_CORREO].tolist():
-        e = normalize_email(v)
-        if e:
-            emails.add(e)
-    return emails
+    return set(normalize_email_series(df[COL_CORREO]).dropna().tolist())
+
+
+def read_emails_from_excel_cached(path: Path, cache: dict, engine: str | None = None) -> tuple[set[str], bool]:
+    """read_emails_from_excel con caché en memoria por (tamaño, mtime). Devuelve (emails, hit)."""
+    sig = snapshot([path]).get(path)
+    cached = cache.get(path)
+    if cached is not None and cached[0] == sig:
+        return cached[1], True
+    emails = read_emails_from_excel(path, engine)
+    cache[path] = (sig, emails)
+    return emails, False
+
+
+def load_existing_emails(
+    emails: list[str],
+    compare_xlsx: list[Path],
+    output_name: str,
+    log: Callable[[str], None],
+    compare_cache: dict | None = None,
+    registry: sqlite3.Connection | None = None,
+    engine: str | None = None,
+    read_only: bool = False,
+) -> set[str]:
+    """Devuelve cuáles de `emails` (normalizados) ya fueron tratados.
+
+    Con `registry` (ver email_registry.py) los compare solo se leen si son nuevos o
+    cambiaron y la consulta se hace en bloque en el registro (ignorando lo registrado desde
+    `output_name`). Con `read_only` el registro solo se consulta: los compare nuevos se leen
+    y se unen sin importarlos (p.ej. en un dry-run). Sin registro, se unen los emails de todos
+    los compare; `compare_cache` permite reutilizar entre llamadas (modo watch) los que no
+    han cambiado.
+    """
+    if compare_cache is None:
+        compare_cache = {}
+
+    existing_emails: set[str] = set()
+    for p in compare_xlsx:
+        if not p.exists():
+            log(f"⚠ No existe compare file: {p.name} (se ignora)")
+            continue
+        if registry is not None:
+            if not email_registry.needs_import(registry, p):
+                log(f"Compare: {p.name} -> ya en el registro")
+                continue
+            compare_emails = read_emails_from_excel(p, engine)
+            if read_only:
+                existing_emails |= compare_emails
+                log(f"Compare: {p.name} -> {len(compare_emails)} emails (sin importar al registro)")
+                continue
+            email_registry.register_emails(registry, compare_emails, p.name)
+            email_registry.mark_imported(registry, p)
+            log(f"Compare: {p.name} -> {len(compare_emails)} emails (importados al registro)")
+            continue
+        compare_emails, hit = read_emails_from_excel_cached(p, compare_cache, engine)
+        log(f"Compare: {p.name} -> {len(compare_emails)} emails{' (caché)' if hit else ''}")
+        existing_emails |= compare_emails
+
+    if registry is not None:
+        existing_emails |= email_registry.known_emails(registry, emails, exclude_source=output_name)
+        log(
+            f"Emails del input ya {'registrados o en compare' if read_only else 'registrados'}: {len(existing_emails)} "
+            f"(registro: {email_registry.count(registry)} emails)"
+        )
+    else:
+        log(f"Total emails existentes (unión): {len(existing_emails)}")
+    return existing_emails
+
+
+def build_faltantes(
+    df_in: pd.DataFrame, existing_emails: set[str], input_name: str, log: Callable[[str], None]
+) -> pd.DataFrame:
+    """Filtra los registros nuevos (sin duplicados, email no tratado) y añade Usuario/Contraseña.
+
+    Devuelve un DataFrame con OUTPUT_COLUMNS, en el orden que espera moodle_excel_sync.py.
+    """
+    df = df_in.copy()
+    df["__email_norm__"] = normalize_email_series(df[COL_CORREO])
+
+    dup_mask = df["__email_norm__"].notna() & df["__email_norm__"].duplicated(keep="first")
+    dup_emails = sorted(set(df.loc[dup_mask, "__email_norm__"].tolist()))
+    if dup_emails:
+        log(f"⚠ Emails duplicados dentro de {input_name}: {len(dup_emails)} (se conserva la primera aparición)")
+        for e in dup_emails[:50]:
+            log(f"  - {e}")
+        if len(dup_emails) > 50:
+            log(f"  ... +{len(dup_emails) - 50} más")
+
+    df = df[df["__email_norm__"].notna()].drop_duplicates(subset=["__email_norm__"], keep="first")
+    df_f = df[~df["__email_norm__"].isin(existing_emails)].copy()
+    log(f"Faltantes detectados (por email): {len(df_f)}")
+
+    for c in (COL_TELEFONO, COL_PAIS):
+        if c not in df_f.columns:
+            df_f[c] = ""
+
+    usuarios, contras, invalid_email, empty_name = build_usuario_contrasena(df_f)
+    df_f[COL_USUARIO] = usuarios
+    df_f[COL_CONTRASENA] = contras
+
+    if invalid_email:
+        log(f"⚠ Emails inválidos (sin @) en faltantes: {invalid_email} (se deja Usuario vacío)")
+    if empty_name:
+        log(f"⚠ Nombres vacíos/problema para contraseña en faltantes: {empty_name} (se deja Contraseña vacía)")
+
+    return pd.DataFrame({c: df_f[c] if c in df_f.columns else "" for c in OUTPUT_COLUMNS})
+
+
+def registrable_emails(df_out: pd.DataFrame) -> list[str]:
+    """Emails de la salida que se registran como tratados: solo los de filas con Usuario
+    (los inválidos, sin @, nunca se podrán sincronizar y no deben bloquear otras ejecuciones)."""
+    con_usuario = _text_series(df_out[COL_USUARIO]) != ""
+    return normalize_email_series(df_out.loc[con_usuario, COL_CORREO]).dropna().tolist()
+
+
+def read_input(input_xlsx: Path, log: Callable[[str], None], engine: str | None = None) -> pd.DataFrame:
+    df_in = read_table(input_xlsx, engine)
+    log(f"Registros input: {len(df_in)}")
+
+    for required in (COL_APELLIDOS, COL_NOMBRE, COL_CORREO):
+        if required not in df_in.columns:
+            raise KeyError(f"No encuentro la columna {required!r} en {input_xlsx.name}. Columnas: {list(df_in.columns)}")
+    return df_in
+
+
+def prepare(
+    input_xlsx: Path,
+    compare_xlsx: list[Path],
+    output_xlsx: Path,
+    log: Callable[[str], None],
+    compare_cache: dict | None = None,
+    registry: sqlite3.Connection | None = None,
+    engine: str | None = None,
+    metrics: RunMetrics | None = None,
+    moodle_emails: set[str] | None = None,
+) -> None:
+    """Genera output_xlsx con los registros de input_xlsx cuyo email no está en compare_xlsx
+    (o en el registro, si se pasa `registry`; los de la salida se registran al terminar).
+    Con `moodle_emails` (emails de un export de Moodle) se excluyen también los que ya existen en Moodle."""
+    metrics = metrics or RunMetrics("prepare_faltantes_por_email", input_xlsx.name)
+    log("Preparando faltantes por email")
+    log(f"Input: {input_xlsx.name}")
+    log(f"Output: {output_xlsx.name}")
+
+    with metrics.phase("leer"):
+        df_in = read_input(input_xlsx, log, engine)
+    metrics.inc("rows_read", len(df_in))
+    with metrics.phase("comparar"):
+        emails = normalize_email_series(df_in[COL_CORREO]).dropna().unique().tolist()
+        existing_emails = load_existing_emails(
+            emails, compare_xlsx, output_xlsx.name, log, compare_cache, registry, engine
+        )
+        if moodle_emails is not None:
+            ya_en_moodle = (set(emails) & moodle_emails) - existing_emails
+            log(f"Emails del input ya en Moodle (export) y no registrados: {len(ya_en_moodle)}")
+            existing_emails = existing_emails | ya_en_moodle
+
+    with metrics.phase("preparar"):
+        df_out = build_faltantes(df_in, existing_emails, input_xlsx.name, log)
+    with metrics.phase("escribir"):
+        write_table(df_out, output_xlsx, sheet_name="Usuarios")
+    metrics.outcome("faltante", len(df_out))
+    metrics.outcome("descartado", len(df_in) - len(df_out))
+
+    log(f"OK generado: {output_xlsx.name} ({len(df_out)} filas)")
+
+    if registry is not None:
+        out_emails = registrable_emails(df_out)
+        email_registry.register_emails(registry, out_emails, output_xlsx.name)
+        email_registry.mark_imported(registry, output_xlsx)
+        log(f"Registro actualizado con {len(out_emails)} emails de {output_xlsx.name}")
+    log(f"Métricas: {metrics.write().name}")
 
 
 def main() -> None:
@@ -81,7 +263,39 @@ def main() -> None:
     parser.add_argument(
         "--output",
         default=None,
-        help="Excel de salida. Si no se indica: <input_stem>_faltantes_rellenado.xlsx",
+        help="Excel de salida (.xlsx, o .csv/.parquet como intermedio). Si no se indica: <input_stem>_faltantes_rellenado.xlsx",
+    )
+    parser.add_argument(
+        "--excel-engine",
+        choices=ENGINES,
+        default=None,
+        help="Motor de lectura .xlsx (por defecto: calamine si está instalado, si no openpyxl)",
+    )
+    parser.add_argument(
+        "--watch",
+        type=float,
+        nargs="?",
+        const=2.0,
+        default=None,
+        metavar="SEGUNDOS",
+        help="Regenera la salida cada vez que cambia el input o un compare (sondeo cada 2s por defecto)",
+    )
+    parser.add_argument(
+        "--registry",
+        type=Path,
+        default=None,
+        help="Registro SQLite de emails ya procesados (por defecto: ./.cache/emails_registry.sqlite)",
+    )
+    parser.add_argument(
+        "--moodle-csv",
+        type=Path,
+        default=None,
+        help="Export CSV de Moodle: excluye también los emails que ya existen en Moodle ('latest' = último snapshot de fetch_moodle_users.py)",
+    )
+    parser.add_argument(
+        "--no-registry",
+        action="store_true",
+        help="No usa el registro: relee todos los --compare en cada ejecución",
     )
 
     args = parser.parse_args()
@@ -111,85 +325,52 @@ def main() -> None:
     except Exception:
         pass
 
-    log("Preparando faltantes por email")
-    log(f"Input: {input_xlsx.name}")
-    log(f"Output: {output_xlsx.name}")
-
-    df_in = pd.read_excel(input_xlsx)
-    log(f"Registros input: {len(df_in)}")
-
-    for required in (COL_APELLIDOS, COL_NOMBRE, COL_CORREO):
-        if required not in df_in.columns:
-            raise KeyError(f"No encuentro la columna {required!r} en {input_xlsx.name}. Columnas: {list(df_in.columns)}")
-
-    # Emails ya existentes (tratados)
-    existing_emails: set[str] = set()
-    for p in compare_xlsx:
-        if not p.exists():
-            log(f"⚠ No existe compare file: {p.name} (se ignora)")
-            continue
-        emails = read_emails_from_excel(p)
-        log(f"Compare: {p.name} -> {len(emails)} emails")
-        existing_emails |= emails
-    log(f"Total emails existentes (unión): {len(existing_emails)}")
-
-    df = df_in.copy()
-    df["__email_norm__"] = df[COL_CORREO].apply(normalize_email)
-
-    dup_mask = df["__email_norm__"].notna() & df["__email_norm__"].duplicated(keep="first")
-    dup_emails = sorted(set(df.loc[dup_mask, "__email_norm__"].tolist()))
-    if dup_emails:
-        log(f"⚠ Emails duplicados dentro de {input_xlsx.name}: {len(dup_emails)} (se conserva la primera aparición)")
-        for e in dup_emails[:50]:
-            log(f"  - {e}")
-        if len(dup_emails) > 50:
-            log(f"  ... +{len(dup_emails) - 50} más")
-
-    df = df[df["__email_norm__"].notna()].drop_duplicates(subset=["__email_norm__"], keep="first")
-    df_f = df[~df["__email_norm__"].isin(existing_emails)].copy()
-    log(f"Faltantes detectados (por email): {len(df_f)}")
-
-    for c in (COL_TELEFONO, COL_PAIS):
-        if c not in df_f.columns:
-            df_f[c] = ""
-
-    invalid_email = 0
-    empty_name = 0
-
-    usuarios = []
-    contras = []
-    for _, row in df_f.iterrows():
-        correo = str(row[COL_CORREO]).strip() if pd.notna(row[COL_CORREO]) else ""
-        nombre = str(row[COL_NOMBRE]).strip() if pd.notna(row[COL_NOMBRE]) else ""
-
-        try:
-            u = email_local_part(correo)
-        except Exception:
-            u = ""
-            invalid_email += 1
+    if args.moodle_csv is not None:
+        resolve_export(args.moodle_csv)  # sin snapshots, falla antes de empezar
+    moodle_state: dict = {}
+
+    def moodle_emails() -> set[str] | None:
+        """Emails del export de Moodle; en modo watch se releen si cambia ('latest' = último snapshot)."""
+        if args.moodle_csv is None:
+            return None
+        moodle_csv = resolve_export(args.moodle_csv)
+        sig = (moodle_csv, snapshot([moodle_csv]).get(moodle_csv))
+        if moodle_state.get("sig") != sig:
+            moodle_state["emails"] = _emails_from_csv(moodle_csv)
+            moodle_state["sig"] = sig
+            log(f"Export de Moodle: {moodle_csv.name} -> {len(moodle_state['emails'])} emails")
+        return moodle_state["emails"]
+
+    def watched() -> list[Path]:
+        moodle_paths = export_paths(args.moodle_csv) if args.moodle_csv is not None else []
+        return [input_xlsx, *compare_xlsx, *moodle_paths]
+
+    registry = None
+    if not args.no_registry:
+        registry = email_registry.open_registry(args.registry or base_dir / ".cache" / "emails_registry.sqlite")
 
-        try:
-            c = f"{first_name(nombre)}+A1+-" if nombre else ""
-        except Exception:
-            c = ""
-            empty_name += 1
-
-        usuarios.append(u)
-        contras.append(c)
-
-    df_f[COL_USUARIO] = usuarios
-    df_f[COL_CONTRASENA] = contras
-
-    if invalid_email:
-        log(f"⚠ Emails inválidos (sin @) en faltantes: {invalid_email} (se deja Usuario vacío)")
-    if empty_name:
-        log(f"⚠ Nombres vacíos/problema para contraseña en faltantes: {empty_name} (se deja Contraseña vacía)")
-
-    df_out = pd.DataFrame({c: df_f[c] if c in df_f.columns else "" for c in OUTPUT_COLUMNS})
-    df_out.to_excel(output_xlsx, index=False, sheet_name="Usuarios")
-
-    log(f"OK generado: {output_xlsx.name} ({len(df_out)} filas)")
-    log(f"Log preparación: {log_file.name}")
+    try:
+        if args.watch is None:
+            prepare(
+                input_xlsx, compare_xlsx, output_xlsx, log,
+                registry=registry, engine=args.excel_engine, moodle_emails=moodle_emails(),
+            )
+            log(f"Log preparación: {log_file.name}")
+            return
+
+        compare_cache: dict = {}
+
+        def run(changed: set[Path]) -> None:
+            log(f"\n=== {datetime.now().strftime('%H:%M:%S')} cambios: {', '.join(sorted(p.name for p in changed))}")
+            prepare(
+                input_xlsx, compare_xlsx, output_xlsx, log, compare_cache, registry, args.excel_engine,
+                moodle_emails=moodle_emails(),
+            )
+
+        watch(watched, run, interval=args.watch, log=log)
+    finally:
+        if registry is not None:
+            registry.close()
 
 
 if __name__ == "__main__":
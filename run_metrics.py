@@ -0,0 +1,230 @@
+"""Métricas por ejecución de cada script (para ver si los intakes se vuelven más lentos).
+
+Cada ejecución deja en logs/metrics/:
+- <script>__<AAAAMMDD_HHMMSS>.json: resumen completo de la ejecución (histórico).
+- <script>.prom: última ejecución en formato texto de Prometheus (para el textfile collector
+  de node_exporter; se escribe de forma atómica).
+
+Uso como comando: compara las últimas ejecuciones de cada script y marca regresiones de
+rendimiento (filas/s de la última ejecución frente a la mediana de las anteriores).
+
+    python run_metrics.py                   # todos los scripts, últimas 5 ejecuciones
+    python run_metrics.py --script moodle_excel_sync --last 10 --threshold 0.3
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import statistics
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent
+METRICS_DIR = BASE_DIR / "logs" / "metrics"
+PROM_PREFIX = "moodle_intake"
+# Contadores que siempre aparecen (aunque valgan 0) para que las series no desaparezcan.
+COUNTERS = ("rows_read", "webdriver_requests", "page_loads", "http_requests")
+
+
+class RunMetrics:
+    """Acumula filas, resultados, tiempos por fase y contadores de una ejecución.
+
+    Seguro entre hilos: la sincronización concurrente actualiza contadores y fases desde
+    varias sesiones a la vez."""
+
+    def __init__(self, script: str, input_name: str = "", metrics_dir: Path = METRICS_DIR) -> None:
+        self.script = script
+        self.input_name = input_name
+        self.metrics_dir = metrics_dir
+        self.started_at = datetime.now()
+        self._t0 = time.perf_counter()
+        self.phases: dict[str, float] = {}
+        self.outcomes: Counter[str] = Counter()
+        self.counters: Counter[str] = Counter({c: 0 for c in COUNTERS})
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str):
+        """Mide el tiempo de pared de un bloque (se acumula si la fase se repite)."""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - t0
+            with self._lock:
+                self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def inc(self, counter: str, n: int = 1) -> None:
+        with self._lock:
+            self.counters[counter] += n
+
+    def outcome(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self.outcomes[name] += n
+
+    def instrument_driver(self, driver):
+        """Cuenta los comandos WebDriver del driver (todos pasan por driver.execute)."""
+        execute = driver.execute
+
+        def counted(command, params=None):
+            with self._lock:
+                self.counters["webdriver_requests"] += 1
+                if command == "get":
+                    self.counters["page_loads"] += 1
+            return execute(command, params)
+
+        driver.execute = counted
+        return driver
+
+    def summary(self) -> dict:
+        duration = time.perf_counter() - self._t0
+        with self._lock:
+            outcomes = dict(self.outcomes)
+            phases = dict(self.phases)
+            counters = dict(self.counters)
+        processed = sum(outcomes.values()) or counters["rows_read"]
+        return {
+            "script": self.script,
+            "input": self.input_name,
+            "started_at": self.started_at.isoformat(timespec="seconds"),
+            "duration_s": round(duration, 4),
+            "rows_read": counters["rows_read"],
+            "rows_processed": processed,
+            "rows_per_second": round(processed / duration, 4) if duration > 0 else 0.0,
+            "outcomes": outcomes,
+            "phases_s": {k: round(v, 4) for k, v in phases.items()},
+            "counters": counters,
+        }
+
+    def write(self) -> Path:
+        """Escribe el JSON de la ejecución y actualiza el .prom del script. Devuelve el JSON."""
+        data = self.summary()
+        self.metrics_dir.mkdir(parents=True, exist_ok=True)
+        stem = f"{self.script}__{self.started_at.strftime('%Y%m%d_%H%M%S')}"
+        json_path = self.metrics_dir / f"{stem}.json"
+        n = 1
+        while json_path.exists():  # varias ejecuciones en el mismo segundo (modo watch)
+            n += 1
+            json_path = self.metrics_dir / f"{stem}_{n}.json"
+        json_path.write_text(json.dumps(data, ensure_ascii=False, indent=2) + "\n", encoding="utf-8")
+
+        prom_path = self.metrics_dir / f"{self.script}.prom"
+        tmp = prom_path.with_suffix(".prom.tmp")
+        tmp.write_text(_to_prometheus(data), encoding="utf-8")
+        os.replace(tmp, prom_path)
+        return json_path
+
+
+def _label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+
+def _to_prometheus(data: dict) -> str:
+    base = f'script="{_label(data["script"])}",input="{_label(data["input"])}"'
+    started = datetime.fromisoformat(data["started_at"]).timestamp()
+    lines = [
+        f"# HELP {PROM_PREFIX}_last_run_timestamp_seconds Inicio de la última ejecución.",
+        f"# TYPE {PROM_PREFIX}_last_run_timestamp_seconds gauge",
+        f"{PROM_PREFIX}_last_run_timestamp_seconds{{{base}}} {started:.0f}",
+        f"# HELP {PROM_PREFIX}_duration_seconds Duración total de la última ejecución.",
+        f"# TYPE {PROM_PREFIX}_duration_seconds gauge",
+        f"{PROM_PREFIX}_duration_seconds{{{base}}} {data['duration_s']}",
+        f"# HELP {PROM_PREFIX}_rows_per_second Filas procesadas por segundo.",
+        f"# TYPE {PROM_PREFIX}_rows_per_second gauge",
+        f"{PROM_PREFIX}_rows_per_second{{{base}}} {data['rows_per_second']}",
+        f"# HELP {PROM_PREFIX}_rows Filas por resultado.",
+        f"# TYPE {PROM_PREFIX}_rows gauge",
+    ]
+    for outcome, n in sorted(data["outcomes"].items()):
+        lines.append(f'{PROM_PREFIX}_rows{{{base},outcome="{_label(outcome)}"}} {n}')
+    lines += [
+        f"# HELP {PROM_PREFIX}_phase_seconds Tiempo de pared por fase.",
+        f"# TYPE {PROM_PREFIX}_phase_seconds gauge",
+    ]
+    for phase, s in data["phases_s"].items():
+        lines.append(f'{PROM_PREFIX}_phase_seconds{{{base},phase="{_label(phase)}"}} {s}')
+    for counter, n in sorted(data["counters"].items()):
+        lines.append(f"# TYPE {PROM_PREFIX}_{counter} gauge")
+        lines.append(f"{PROM_PREFIX}_{counter}{{{base}}} {n}")
+    return "\n".join(lines) + "\n"
+
+
+def load_runs(metrics_dir: Path = METRICS_DIR, script: str | None = None) -> dict[str, list[dict]]:
+    """JSON de ejecuciones agrupados por script, ordenados del más antiguo al más reciente."""
+    runs: dict[str, list[dict]] = {}
+    pattern = f"{script}__*.json" if script else "*__*.json"
+    for path in sorted(metrics_dir.glob(pattern)):
+        try:
+            data = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            continue
+        runs.setdefault(data.get("script", path.stem.split("__")[0]), []).append(data)
+    for lst in runs.values():
+        lst.sort(key=lambda d: d.get("started_at", ""))
+    return runs
+
+
+def find_regressions(runs: list[dict], last: int = 5, threshold: float = 0.2) -> tuple[float | None, bool]:
+    """Compara filas/s de la última ejecución con la mediana de las `last` anteriores.
+
+    Devuelve (mediana, regresión). Sin historial suficiente: (None, False). Las ejecuciones
+    sin filas no miden rendimiento: no cuentan como referencia y, si es la última, no se marca.
+    """
+    previous = [r["rows_per_second"] for r in runs[-last - 1 : -1] if r.get("rows_per_second")]
+    if not previous:
+        return None, False
+    if not runs[-1].get("rows_processed"):
+        return statistics.median(previous), False
+    median = statistics.median(previous)
+    return median, runs[-1]["rows_per_second"] < median * (1 - threshold)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Compara las últimas ejecuciones de cada script y marca regresiones de filas/s."
+    )
+    parser.add_argument("--dir", type=Path, default=METRICS_DIR, help="Carpeta de métricas (por defecto: ./logs/metrics)")
+    parser.add_argument("--script", default=None, help="Solo este script (p.ej. moodle_excel_sync)")
+    parser.add_argument("--last", type=int, default=5, help="Ejecuciones anteriores usadas como referencia (por defecto: 5)")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="Caída relativa de filas/s que cuenta como regresión (por defecto: 0.2 = 20%%)",
+    )
+    args = parser.parse_args()
+
+    runs_by_script = load_runs(args.dir, args.script)
+    if not runs_by_script:
+        print(f"No hay métricas en {args.dir}")
+        return 0
+
+    any_regression = False
+    for script, runs in sorted(runs_by_script.items()):
+        print(f"\n{script} ({len(runs)} ejecuciones)")
+        for r in runs[-args.last - 1 :]:
+            fases = ", ".join(f"{k}={v:.2f}s" for k, v in r.get("phases_s", {}).items())
+            print(
+                f"  {r['started_at']}  {r['rows_processed']:>7} filas  {r['duration_s']:>9.2f} s  "
+                f"{r['rows_per_second']:>9.2f} filas/s  [{fases}]"
+            )
+        median, regression = find_regressions(runs, args.last, args.threshold)
+        if median is None:
+            print("  (sin historial suficiente para comparar)")
+        elif regression:
+            any_regression = True
+            print(f"  ✗ REGRESIÓN: {runs[-1]['rows_per_second']:.2f} filas/s frente a mediana {median:.2f}")
+        else:
+            print(f"  ✓ OK frente a mediana {median:.2f} filas/s")
+
+    return 0 if not any_regression else 2
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,160 @@
+"""Registro de usuario y reglas de normalización compartidas por todos los scripts.
+
+Antes cada script tenía su propia copia de estas funciones; ahora el preparador, el
+completado, la sincronización y pipeline.py usan las mismas.
+"""
+
+from __future__ import annotations
+
+from collections.abc import Callable
+from typing import NamedTuple, TypedDict
+
+import pandas as pd
+
+
+class Registro(TypedDict):
+    """Un usuario listo para crear/editar en Moodle (lo que consume procesar_usuario)."""
+
+    fila: int
+    nombre: str
+    apellidos: str
+    email: str
+    usuario: str
+    contrasena: str | None
+
+
+def normalize_email(value) -> str | None:
+    if value is None or (isinstance(value, float) and pd.isna(value)):
+        return None
+    s = str(value).strip().lower()
+    if not s:
+        return None
+    return s
+
+
+def email_local_part(email: str) -> str:
+    email = (email or "").strip()
+    if "@" not in email:
+        raise ValueError(f"Email inválido (sin @): {email!r}")
+    return email.split("@", 1)[0].strip()
+
+
+def first_name(nombre: str) -> str:
+    nombre = (nombre or "").strip()
+    if not nombre:
+        raise ValueError("Nombre vacío, no puedo generar contraseña.")
+    return nombre.split()[0]
+
+
+def _solo_mayusculas(texto: str) -> bool:
+    letras = [c for c in texto if c.isalpha()]
+    return bool(letras) and all(c.isupper() for c in letras)
+
+
+def normalizar_nombre(texto: str, mayusculas_a_titulo: bool = True) -> str:
+    """Quita espacios y, si el texto viene TODO EN MAYÚSCULAS, lo pasa a formato título."""
+    s = (texto or "").strip()
+    if mayusculas_a_titulo and _solo_mayusculas(s):
+        return s.title()
+    return s
+
+
+def password_for(nombre: str) -> str:
+    """Contraseña temporal: primer nombre + '+A1+-'."""
+    return f"{first_name(nombre)}+A1+-"
+
+
+def nuevo_registro(
+    fila: int,
+    apellidos,
+    nombre,
+    email,
+    usuario,
+    contrasena,
+    normalizar_nombre: Callable[[str], str] = str.strip,
+) -> Registro | None:
+    """Construye un Registro a partir de los valores de una fila, o None si le falta
+    nombre, apellidos, email o usuario (esas filas no se pueden sincronizar)."""
+    if not (nombre and apellidos and email and usuario):
+        return None
+    return {
+        'fila': fila,
+        'nombre': normalizar_nombre(str(nombre)),
+        'apellidos': normalizar_nombre(str(apellidos)),
+        'email': str(email).strip(),
+        'usuario': str(usuario).strip().lower(),
+        'contrasena': str(contrasena).strip() if contrasena else None,
+    }
+
+
+CAMPOS_OBLIGATORIOS = ("nombre", "apellidos", "email", "usuario")
+# Lo mínimo para que Moodle acepte el alta: algo@dominio.tld, sin espacios
+EMAIL_VALIDO = r"[^@\s]+@[^@\s]+\.[^@\s]+"
+# Usuario de Moodle (en minúsculas): letras, números y _ - . @
+USUARIO_VALIDO = r"[a-z0-9_.@-]+"
+
+
+def motivos_rechazo(df: pd.DataFrame) -> pd.Series:
+    """Motivo por el que no se puede sincronizar cada fila ("" si es válida), de una vez
+    para toda la tabla. `df` necesita las columnas de CAMPOS_OBLIGATORIOS."""
+    texto = {c: df[c].astype(object).where(df[c].notna(), "").astype(str).str.strip() for c in CAMPOS_OBLIGATORIOS}
+    motivo = pd.Series("", index=df.index, dtype=object)
+    for campo in CAMPOS_OBLIGATORIOS:
+        motivo = motivo.mask((motivo == "") & (texto[campo] == ""), f"falta {campo}")
+    email_ok = texto["email"].str.fullmatch(EMAIL_VALIDO)
+    motivo = motivo.mask((motivo == "") & ~email_ok, "email inválido: " + texto["email"])
+    usuario_ok = texto["usuario"].str.lower().str.fullmatch(USUARIO_VALIDO)
+    motivo = motivo.mask((motivo == "") & ~usuario_ok, "usuario inválido: " + texto["usuario"])
+    return motivo
+
+
+# Qué registro se sincroniza cuando varias filas comparten email (normalizado):
+# - primera: el de la primera fila (lo que avisa excel_completion.py).
+# - ultima: el de la última fila (la inscripción más reciente), en la posición de la primera.
+# - omitir_conflictos: como 'primera', pero si las filas tienen nombres distintos no se
+#   sincroniza ninguna (puede que sean dos personas con el mismo email: revisar a mano).
+POLITICAS_DUPLICADOS = ("primera", "ultima", "omitir_conflictos")
+
+
+class Colapso(NamedTuple):
+    """Filas con el mismo email: el registro elegido (None si se omiten) y todas las filas."""
+
+    email: str
+    elegido: Registro | None
+    filas: list[Registro]
+    conflicto: bool
+
+
+def _nombre_completo(r: Registro) -> str:
+    return " ".join(f"{r['nombre']} {r['apellidos']}".split()).casefold()
+
+
+def colapsar_por_email(registros: list[Registro], politica: str = "primera") -> tuple[list[Registro], list[Colapso]]:
+    """Deja un único registro por email normalizado según `politica` (POLITICAS_DUPLICADOS).
+
+    Devuelve (registros a sincronizar en el orden original, colapsos para el log).
+    """
+    if politica not in POLITICAS_DUPLICADOS:
+        raise ValueError(f"Política de duplicados inválida: {politica!r} (opciones: {', '.join(POLITICAS_DUPLICADOS)})")
+
+    grupos: dict[str, list[Registro]] = {}
+    for r in registros:
+        grupos.setdefault(normalize_email(r['email']) or "", []).append(r)
+
+    resultado: list[Registro] = []
+    colapsos: list[Colapso] = []
+    for email, filas in grupos.items():
+        if len(filas) == 1:
+            resultado.append(filas[0])
+            continue
+        conflicto = len({_nombre_completo(r) for r in filas}) > 1
+        if politica == "ultima":
+            elegido = filas[-1]
+        elif politica == "omitir_conflictos" and conflicto:
+            elegido = None
+        else:
+            elegido = filas[0]
+        if elegido is not None:
+            resultado.append(elegido)
+        colapsos.append(Colapso(email, elegido, filas, conflicto))
+    return resultado, colapsos